@@ -0,0 +1,454 @@
+"""
+Concurrent load harness for the example app.
+
+Seeds a database with parents and children that each have a deep audit
+history, then drives concurrent create, update, delete and audit viewer
+requests against the ASGI app in process and reports the throughput and
+p50/p99 latencies per route:
+
+    python -m example.loadtest --database-url sqlite:///example/loadtest.sqlite3
+    python -m example.loadtest --database-url postgresql://localhost/loadtest
+
+Everything runs on a single event loop, the same as a single uvicorn worker, so
+time spent blocking the loop shows up as latency on every route. The worst
+delays of a timer running alongside the requests are reported as loop lag.
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from urllib.parse import urlencode
+
+import sqlalchemy as sa
+
+from starlette_audit.tables import insert_entries
+
+# relative weight of every route in the generated traffic
+WEIGHTS = {
+    "parent create": 1,
+    "parent update": 4,
+    "child create": 2,
+    "child update": 8,
+    "child delete": 1,
+    "audit log list": 2,
+    "audit log entry": 4,
+    "parent audit log": 3,
+    "child audit log": 3,
+}
+
+
+def percentile(values: typing.List[float], percent: float) -> float:
+    """ Returns the nearest rank percentile of `values` """
+
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def history_entries(
+    entity_type: str, row: dict, depth: int, start: datetime
+) -> typing.List[dict]:
+    """
+    Returns `depth` audit log entries for a seeded row, an insert followed by
+    updates that end with its current values.
+    """
+
+    entries = []
+    for version in range(depth):
+        data = dict(row)
+        if version < depth - 1:
+            data["name"] = "%s v%s" % (row["name"], version + 1)
+        entries.append(
+            {
+                "entity_type": entity_type,
+                "entity_type_id": row["id"],
+                "entity_name": data["name"],
+                "operation": "INSERT" if version == 0 else "UPDATE",
+                "created_on": start + timedelta(minutes=version),
+                "created_by_id": None,
+                "data": {
+                    key: str(value) if isinstance(value, Decimal) else value
+                    for key, value in data.items()
+                },
+                "extra_data": {},
+            }
+        )
+    return entries
+
+
+def seed(
+    engine,
+    parents: int,
+    children: int,
+    history: int,
+    batch_size: int = 1000,
+    rng: typing.Optional[random.Random] = None,
+) -> None:
+    """
+    Inserts `parents` and `children` with `history` audit log entries each,
+    in batches of `batch_size` rows. Does nothing if there are already parents
+    so a seeded database can be reused between runs.
+    """
+
+    from .models import AuditLog, Child, Parent
+
+    rng = rng or random.Random()
+
+    with engine.connect() as conn:
+        count = sa.select([sa.func.count()]).select_from(Parent.__table__)
+        if conn.execute(count).scalar():
+            return
+
+    def parent_values(i):
+        return {"id": i, "name": "parent %s" % i}
+
+    def child_values(i):
+        return {
+            "id": i,
+            "name": "child %s" % i,
+            "parent_id": rng.randint(1, parents),
+            "age": rng.randint(1, 18),
+            "height": Decimal(rng.randint(50, 200)) / 100,
+        }
+
+    start = datetime.utcnow() - timedelta(minutes=history)
+
+    for model, count, values in (
+        (Parent, parents, parent_values),
+        (Child, children, child_values),
+    ):
+        table = model.__table__
+        for offset in range(0, count, batch_size):
+            rows = [
+                values(i)
+                for i in range(offset + 1, min(offset + batch_size, count) + 1)
+            ]
+            entries = [
+                entry
+                for row in rows
+                for entry in history_entries(table.name, row, history, start)
+            ]
+            with engine.begin() as conn:
+                conn.execute(table.insert(), rows)
+                insert_entries(conn, AuditLog, entries)
+
+        if engine.dialect.name == "postgresql":
+            # ids were set explicitly, move the sequence past them
+            engine.execute(
+                sa.text(
+                    "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                    "(SELECT max(id) FROM %s))" % table.name
+                ),
+                table=table.name,
+            )
+
+
+async def call(app, method: str, path: str, form: typing.Optional[dict] = None):
+    """
+    Sends a single request to `app` in process and returns the status code
+    once the response has been completed.
+    """
+
+    body = urlencode(form).encode() if form is not None else b""
+    headers = [(b"host", b"testserver")]
+    if form is not None:
+        headers += [
+            (b"content-type", b"application/x-www-form-urlencoded"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+
+    sent = False
+    completed = asyncio.Event()
+    status = None
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await completed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            if not message.get("more_body", False):
+                completed.set()
+
+    await app(scope, receive, send)
+    return status
+
+
+class Traffic:
+    """
+    Builds the requests for every route in `WEIGHTS`, using the example admins
+    to resolve the urls. Only children created during the run are deleted, so
+    the seeded rows can be reused by the next run.
+    """
+
+    def __init__(
+        self,
+        app,
+        engine,
+        rng: random.Random,
+        parents: int,
+        children: int,
+        entries: int,
+    ):
+        from .admin import AuditAdmin, ChildAdmin, ParentAdmin
+
+        self.app = app
+        self.engine = engine
+        self.rng = rng
+        self.parent_urls = ParentAdmin.url_names()
+        self.child_urls = ChildAdmin.url_names()
+        self.audit_urls = AuditAdmin.url_names()
+        self.parents = parents
+        self.children = children
+        self.entries = entries
+        # names are unique, keep them unique across runs on the same database
+        self.prefix = "%x" % int(time.time())
+        self.counter = 0
+        self.created: typing.List[str] = []
+
+    def url(self, name: str, **params) -> str:
+        return self.app.url_path_for(name, **params)
+
+    def unique_name(self, prefix: str) -> str:
+        self.counter += 1
+        return "%s %s-%s" % (prefix, self.prefix, self.counter)
+
+    def child_form(self, name: str) -> dict:
+        return {
+            "name": name,
+            "age": self.rng.randint(1, 18),
+            "height": "%.2f" % self.rng.uniform(0.5, 2),
+            "parent": self.rng.randint(1, self.parents),
+        }
+
+    def request(self, route: str) -> typing.Tuple[str, str, typing.Optional[dict]]:
+        """ Returns the method, path and form of a request to `route` """
+
+        rng = self.rng
+
+        if route == "parent create":
+            form = {"name": self.unique_name("parent")}
+            return "POST", self.url(self.parent_urls["create"]), form
+        if route == "parent update":
+            parent_id = rng.randint(1, self.parents)
+            form = {"name": self.unique_name("parent")}
+            return "POST", self.url(self.parent_urls["update"], id=parent_id), form
+        if route == "child create":
+            form = self.child_form(self.unique_name("child"))
+            self.created.append(form["name"])
+            return "POST", self.url(self.child_urls["create"]), form
+        if route == "child delete":
+            child_id = self.created_child_id()
+            if child_id is not None:
+                return "POST", self.url(self.child_urls["delete"], id=child_id), {}
+            route = "child update"
+        if route == "child update":
+            child_id = rng.randint(1, self.children)
+            form = self.child_form(self.unique_name("child"))
+            return "POST", self.url(self.child_urls["update"], id=child_id), form
+        if route == "audit log list":
+            return "GET", self.url(self.audit_urls["list"]), None
+        if route == "audit log entry":
+            item_id = rng.randint(1, self.entries)
+            return "GET", self.url(self.audit_urls["audit_item"], item_id=item_id), None
+        if route == "parent audit log":
+            parent_id = rng.randint(1, self.parents)
+            return "GET", self.url(self.parent_urls["audit"], id=parent_id), None
+        if route == "child audit log":
+            child_id = rng.randint(1, self.children)
+            return "GET", self.url(self.child_urls["audit"], id=child_id), None
+
+        raise ValueError("unknown route %r" % route)
+
+    def created_child_id(self) -> typing.Optional[int]:
+        """ Returns the id of the oldest child created during the run, if any """
+
+        from .models import Child
+
+        while self.created:
+            name = self.created.pop(0)
+            table = Child.__table__
+            child_id = self.engine.execute(
+                sa.select([table.c.id]).where(table.c.name == name)
+            ).scalar()
+            if child_id is not None:
+                return child_id
+        return None
+
+
+async def run(
+    app,
+    requests: int,
+    concurrency: int,
+    pick: typing.Callable[[], str],
+    build: typing.Callable[[str], typing.Tuple[str, str, typing.Optional[dict]]],
+) -> dict:
+    """
+    Sends `requests` requests to `app` from `concurrency` concurrent clients,
+    each picking its next route with `pick` and building the request with
+    `build`. Returns the latencies and errors per route, the loop lag and the
+    elapsed time.
+
+    Routes are picked and built in a single worker thread, as building some
+    requests queries the database, which would otherwise count as loop lag.
+    """
+
+    latencies: typing.Dict[str, typing.List[float]] = {}
+    errors: typing.Dict[str, int] = {}
+    lags: typing.List[float] = []
+    remaining = requests
+    done = False
+    loop = asyncio.get_running_loop()
+    builder = ThreadPoolExecutor(max_workers=1)
+
+    def next_request():
+        route = pick()
+        return (route, *build(route))
+
+    async def client():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            route, method, path, form = await loop.run_in_executor(
+                builder, next_request
+            )
+            started = time.perf_counter()
+            try:
+                status = await call(app, method, path, form)
+            except Exception:
+                status = None
+            latencies.setdefault(route, []).append(time.perf_counter() - started)
+            if status is None or status >= 400:
+                errors[route] = errors.get(route, 0) + 1
+
+    async def monitor(interval=0.01):
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - started - interval)
+
+    lag_task = asyncio.ensure_future(monitor())
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+    finally:
+        elapsed = time.perf_counter() - started
+        done = True
+        await lag_task
+        builder.shutdown()
+
+    return {"latencies": latencies, "errors": errors, "lags": lags, "elapsed": elapsed}
+
+
+def report(results: dict) -> str:
+    """ Formats the results of `run` as a table """
+
+    elapsed = results["elapsed"]
+    lines = [
+        "%-20s %8s %8s %10s %10s %10s"
+        % ("route", "requests", "errors", "req/s", "p50 ms", "p99 ms")
+    ]
+    total = 0
+    for route, latencies in sorted(results["latencies"].items()):
+        total += len(latencies)
+        lines.append(
+            "%-20s %8d %8d %10.1f %10.1f %10.1f"
+            % (
+                route,
+                len(latencies),
+                results["errors"].get(route, 0),
+                len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000,
+            )
+        )
+    lines.append(
+        "%-20s %8d %8d %10.1f"
+        % ("total", total, sum(results["errors"].values()), total / elapsed)
+    )
+    if results["lags"]:
+        lines.append(
+            "loop lag p50 %.1f ms, p99 %.1f ms, max %.1f ms"
+            % (
+                percentile(results["lags"], 50) * 1000,
+                percentile(results["lags"], 99) * 1000,
+                max(results["lags"]) * 1000,
+            )
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", default="sqlite:///example/loadtest.sqlite3")
+    parser.add_argument("--parents", type=int, default=1000)
+    parser.add_argument("--children", type=int, default=10000)
+    parser.add_argument("--history", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from starlette_core.database import Database, DatabaseURL
+
+    from .main import app
+
+    # rebinds the session used by the app to the load test database
+    db = Database(DatabaseURL(args.database_url))
+    db.create_all()
+
+    rng = random.Random(args.seed)
+
+    started = time.perf_counter()
+    seed(db.engine, args.parents, args.children, args.history, rng=rng)
+    print("seeded in %.1fs" % (time.perf_counter() - started))
+
+    from .models import AuditLog
+
+    count = sa.select([sa.func.count()]).select_from(AuditLog.__table__)
+    entries = db.engine.execute(count).scalar()
+    traffic = Traffic(app, db.engine, rng, args.parents, args.children, entries)
+    routes = list(WEIGHTS)
+    weights = [WEIGHTS[route] for route in routes]
+
+    results = asyncio.run(
+        run(
+            app,
+            args.requests,
+            args.concurrency,
+            lambda: rng.choices(routes, weights)[0],
+            traffic.request,
+        )
+    )
+    print(report(results))
+
+
+if __name__ == "__main__":
+    main()
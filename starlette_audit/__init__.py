@@ -1,5 +1,5 @@
 __version__ = "0.0.1"
 
-from . import admin, tables
+from . import admin, backfill, integrity, tables
 
-__all__ = ["admin", "tables"]
+__all__ = ["admin", "backfill", "integrity", "tables"]
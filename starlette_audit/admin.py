@@ -1,37 +1,178 @@
+import hashlib
+import typing
+from collections import OrderedDict
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
 import sqlalchemy as sa
 from sqlalchemy import orm
 from starlette.authentication import has_required_scope
+from starlette.exceptions import HTTPException
+from starlette.responses import RedirectResponse, Response
 from starlette.routing import Route, Router
 from starlette_admin import config
 from starlette_admin.admin import BaseAdmin, ModelAdmin
 from starlette_core.database import Base
 
 
+class DiffCache:
+    """
+    In process LRU cache of rendered diff tables. Entries never change once
+    written so their rendered diffs can be reused, they are cached separately
+    for every set of permission scopes.
+
+    class AuditAdmin(AuditLogAdmin):
+        audit_log_diff_cache = DiffCache(maxsize=1000)
+    """
+
+    def __init__(self, maxsize: int = 1000) -> None:
+        self.maxsize = maxsize
+        self.items: "OrderedDict[typing.Hashable, str]" = OrderedDict()
+
+    def get(self, key: typing.Hashable) -> typing.Optional[str]:
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def set(self, key: typing.Hashable, value: str) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+def entry_cache_headers(request, audit_log_class, item_id, diff_id) -> dict:
+    """
+    Returns the caching headers for an entry or diff page. Entries never change
+    but the page also lists the newer entries of the same entity, so the
+    validators are derived from the ids shown and the newest entry's id and
+    date, read in a single query without loading any entries.
+    """
+
+    later = orm.aliased(audit_log_class)
+    newest_id, newest_on = (
+        audit_log_class.query.join(
+            later,
+            sa.and_(
+                later.entity_type == audit_log_class.entity_type,
+                later.entity_type_id == audit_log_class.entity_type_id,
+            ),
+        )
+        .filter(audit_log_class.id == item_id)
+        .with_entities(sa.func.max(later.id), sa.func.max(later.created_on))
+        .one()
+    )
+    if newest_id is None:
+        raise HTTPException(404)
+
+    user = request.user.display_name if request.user.is_authenticated else ""
+    scopes = sorted(request.auth.scopes)
+    key = repr((audit_log_class.__name__, item_id, diff_id, newest_id, scopes, user))
+
+    return {
+        "ETag": '"%s"' % hashlib.sha1(key.encode()).hexdigest(),
+        "Last-Modified": format_datetime(
+            newest_on.replace(tzinfo=timezone.utc), usegmt=True
+        ),
+        "Cache-Control": "private, no-cache",
+    }
+
+
+def is_not_modified(request, headers: dict) -> bool:
+    """ Checks the conditional request headers against `entry_cache_headers` """
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        return "*" in tags or headers["ETag"] in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]) <= since
+
+    return False
+
+
+def render_diff_table(template: str, item, diff) -> str:
+    """ Renders the table comparing `item` to `diff`, or just `item` """
+
+    items = item.data_keys
+    extra_items = item.extra_data_keys
+    if diff:
+        items = sorted(list(set(items + diff.data_keys)))
+        extra_items = sorted(list(set(extra_items + diff.extra_data_keys)))
+
+    return config.templates.get_template(template).render(
+        {"item": item, "diff": diff, "items": items, "extra_items": extra_items}
+    )
+
+
+def get_entry_diff(
+    request, audit_log_class, item_id, diff_id, template: str, cache=None
+):
+    """
+    Returns the entry, the entry it is compared to and the rendered diff table.
+    When the table is already in `cache` the entries are loaded without their
+    payloads.
+    """
+
+    cache_key = (audit_log_class, tuple(sorted(request.auth.scopes)), item_id, diff_id)
+    diff_table = cache.get(cache_key) if cache is not None else None
+
+    qs = audit_log_class.query
+    if diff_table is not None:
+        qs = qs.options(audit_log_class.without_payload())
+
+    item = qs.get_or_404(item_id)
+    diff = qs.get_or_404(diff_id) if diff_id else None
+
+    if diff_table is None:
+        diff_table = render_diff_table(template, item, diff)
+        if cache is not None:
+            cache.set(cache_key, diff_table)
+
+    return item, diff, diff_table
+
+
 class AuditedModelAdmin(ModelAdmin):
     list_template: str = "starlette_audit/list.html"
     update_template: str = "starlette_audit/update.html"
     audit_log_item_list_template: str = "starlette_audit/item_audit_list.html"
     audit_log_item_template: str = "starlette_audit/item_audit.html"
     audit_log_deleted_template: str = "starlette_audit/deleted_entries.html"
+    audit_log_diff_template: str = "starlette_audit/partials/entry_diff.html"
+    audit_log_diff_cache: typing.Optional[DiffCache] = None
 
     @classmethod
     def audit_log_class(cls):
-        return cls.model_class.audit_class()
+        return cls.model_class.audit_table_class()
 
     @classmethod
     async def audit_log_deleted_view(cls, request):
         if not has_required_scope(request, cls.permission_scopes):
             raise HTTPException(403)
 
+        audit_log_class = cls.audit_log_class()
         list_objects = (
-            cls.audit_log_class()
-            .query.filter_by(
-                entity_type=cls.model_class.__table__.name, operation="DELETE"
-            )
+            audit_log_class.query.options(audit_log_class.without_payload())
+            .filter_by(entity_type=cls.model_class.__table__.name, operation="DELETE")
             .all()
         )
         context = cls.get_context(request)
-        context.update({"list_objects": list_objects})
+        context.update(
+            {
+                "list_objects": list_objects,
+                "restorable_ids": audit_log_class.deleted_entity_ids(
+                    cls.model_class.__table__.name
+                ),
+            }
+        )
 
         return config.templates.TemplateResponse(
             cls.audit_log_deleted_template, context
@@ -43,7 +184,7 @@ class AuditedModelAdmin(ModelAdmin):
             raise HTTPException(403)
 
         instance = cls.get_object(request)
-        instance.auditlog
+        cls.load_audit_log(instance)
         context = cls.get_context(request)
         context.update({"object": instance})
 
@@ -52,37 +193,72 @@ class AuditedModelAdmin(ModelAdmin):
         )
 
     @classmethod
-    async def audit_log_item_view(cls, request):
+    def load_audit_log(cls, instance):
+        """
+        Loads `instance.auditlog` without the `data` and `extra_data` payloads
+        as the list of entries doesn't display them.
+        """
+
+        audit_log_class = cls.audit_log_class()
+        entries = (
+            audit_log_class.query.options(audit_log_class.without_payload())
+            .with_parent(instance, "auditlog")
+            .order_by(sa.desc(audit_log_class.created_on))
+            .all()
+        )
+        orm.attributes.set_committed_value(instance, "auditlog", entries)
+
+    @classmethod
+    async def audit_log_restore_view(cls, request):
         if not has_required_scope(request, cls.permission_scopes):
             raise HTTPException(403)
 
-        instance = cls.get_object(request)
+        instance = cls.model_class.restore_deleted(request.path_params["entity_id"])
+        if instance is None:
+            raise HTTPException(404)
 
-        item_id = request.path_params["item_id"]
-        item = cls.audit_log_class().query.get_or_404(item_id)
+        try:
+            instance.save()
+        except sa.exc.IntegrityError:
+            # eg a unique value since taken by another row
+            raise HTTPException(409)
 
-        items = item.data_keys
-        extra_items = item.extra_data_keys
+        return RedirectResponse(
+            url=request.url_for(cls.url_names()["list"]), status_code=302
+        )
 
-        diff = None
-        diff_id = request.path_params.get("diff_id")
-        if diff_id:
-            diff = cls.audit_log_class().query.get_or_404(diff_id)
-            items = sorted(list(set(items + diff.data_keys)))
-            extra_items = sorted(list(set(extra_items + diff.extra_data_keys)))
+    @classmethod
+    async def audit_log_item_view(cls, request):
+        if not has_required_scope(request, cls.permission_scopes):
+            raise HTTPException(403)
+
+        headers = entry_cache_headers(
+            request,
+            cls.audit_log_class(),
+            request.path_params["item_id"],
+            request.path_params.get("diff_id"),
+        )
+        if is_not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+
+        instance = cls.get_object(request)
+        item, diff, diff_table = get_entry_diff(
+            request,
+            cls.audit_log_class(),
+            request.path_params["item_id"],
+            request.path_params.get("diff_id"),
+            cls.audit_log_diff_template,
+            cls.audit_log_diff_cache,
+        )
 
         context = cls.get_context(request)
         context.update(
-            {
-                "object": instance,
-                "item": item,
-                "diff": diff,
-                "items": items,
-                "extra_items": extra_items,
-            }
+            {"object": instance, "item": item, "diff": diff, "diff_table": diff_table}
         )
 
-        return config.templates.TemplateResponse(cls.audit_log_item_template, context)
+        return config.templates.TemplateResponse(
+            cls.audit_log_item_template, context, headers=headers
+        )
 
     @classmethod
     def url_names(cls):
@@ -90,6 +266,7 @@ class AuditedModelAdmin(ModelAdmin):
         mount = cls.mount_name()
         url_names["audit"] = f"{cls.site.name}:{mount}_audit"
         url_names["audit_deleted"] = f"{cls.site.name}:{mount}_audit_deleted"
+        url_names["audit_restore"] = f"{cls.site.name}:{mount}_audit_restore"
         url_names["audit_item"] = f"{cls.site.name}:{mount}_audit_item"
         url_names["audit_item_diff"] = f"{cls.site.name}:{mount}_audit_item_diff"
         return url_names
@@ -110,6 +287,12 @@ class AuditedModelAdmin(ModelAdmin):
             methods=["GET"],
             name=f"{mount}_audit_deleted",
         )
+        routes.add_route(
+            path="/audit/deleted/{entity_id}/restore",
+            endpoint=cls.audit_log_restore_view,
+            methods=["POST"],
+            name=f"{mount}_audit_restore",
+        )
         routes.add_route(
             path=f"/{cls.routing_id_part}/audit/{{item_id}}",
             endpoint=cls.audit_log_item_view,
@@ -128,70 +311,169 @@ class AuditedModelAdmin(ModelAdmin):
 class AuditLogAdmin(BaseAdmin):
     audit_log_class: Base
     audit_log_limit_records: int = 100
+    audit_log_load_instances: bool = False
     search_enabled: bool = True
     list_template: str = "starlette_audit/audit_log_list.html"
     item_template: str = "starlette_audit/audit_log_item.html"
+    diff_template: str = "starlette_audit/partials/entry_diff.html"
+    audit_log_diff_cache: typing.Optional[DiffCache] = None
 
     @classmethod
     def get_context(cls, request):
         context = super().get_context(request)
-        context.update({"limit": cls.audit_log_limit_records})
+        context.update(
+            {
+                "limit": cls.audit_log_limit_records,
+                "load_instances": cls.audit_log_load_instances,
+            }
+        )
         return context
 
     @classmethod
     def get_list_objects(cls, request):
-        qs = cls.audit_log_class.query
-        qs = qs.options(orm.contains_eager("created_by"))
-        qs = qs.outerjoin("created_by")
         search = request.query_params.get("search", "").strip().lower()
-        if search:
-            qs = cls.get_search_results(qs, search)
-        return (
-            qs.order_by(sa.desc(cls.audit_log_class.created_on))
-            .limit(cls.audit_log_limit_records)
-            .all()
-        )
+        if cls.audit_log_class.per_model_tables:
+            list_objects = cls.get_merged_list_objects(search)
+        else:
+            qs = cls.audit_log_class.query
+            qs = qs.options(
+                cls.audit_log_class.without_payload(), orm.contains_eager("created_by"),
+            )
+            qs = qs.outerjoin("created_by")
+            if search:
+                qs = cls.get_search_results(qs, search)
+            list_objects = (
+                qs.order_by(sa.desc(cls.audit_log_class.created_on))
+                .limit(cls.audit_log_limit_records)
+                .all()
+            )
+        if cls.audit_log_load_instances:
+            cls.audit_log_class.load_audited_instances(list_objects)
+        return list_objects
+
+    @classmethod
+    def get_merged_list_objects(cls, search: str) -> list:
+        """
+        Lists the latest entries across the tables of a per model audit log.
+        The latest keys of every table, each read from its own index, are merged
+        with a `UNION ALL` and the entries are then loaded from their tables.
+        """
+
+        classes = cls.audit_log_class.model_audit_classes()
+        if not classes:
+            return []
+
+        latest = []
+        for audit_log_class in classes.values():
+            qs = audit_log_class.query.outerjoin("created_by")
+            if search:
+                qs = cls.get_search_results(qs, search)
+            latest.append(
+                qs.with_entities(
+                    audit_log_class.entity_type,
+                    audit_log_class.id,
+                    audit_log_class.created_on,
+                )
+                .order_by(
+                    sa.desc(audit_log_class.created_on), sa.desc(audit_log_class.id)
+                )
+                .limit(cls.audit_log_limit_records)
+                .subquery()
+                .select()
+            )
+
+        # any of the classes routes the query to the bind of the audit log
+        mapper = next(iter(classes.values()))
+        merged = sa.union_all(*latest).alias()
+        keys = [
+            (row.entity_type, row.id)
+            for row in mapper.query.session.execute(
+                sa.select([merged.c.entity_type, merged.c.id])
+                .order_by(sa.desc(merged.c.created_on), sa.desc(merged.c.id))
+                .limit(cls.audit_log_limit_records),
+                mapper=mapper,
+            )
+        ]
+
+        ids: typing.Dict[str, typing.List[int]] = {}
+        for entity_type, entry_id in keys:
+            ids.setdefault(entity_type, []).append(entry_id)
+
+        entries = {}
+        for entity_type, entry_ids in ids.items():
+            audit_log_class = classes[entity_type]
+            for entry in audit_log_class.query.options(
+                audit_log_class.without_payload(), orm.joinedload("created_by")
+            ).filter(audit_log_class.id.in_(entry_ids)):
+                entries[(entity_type, entry.id)] = entry
+
+        return [entries[key] for key in keys if key in entries]
 
     @classmethod
     def get_search_results(cls, qs: orm.Query, term: str) -> orm.Query:
-        user_cls = cls.audit_log_class.__mapper__.relationships["created_by"].argument
+        audit_log_class = qs.column_descriptions[0]["entity"]
+        user_cls = audit_log_class.__mapper__.relationships["created_by"].argument
         for t in term.split(" "):
             search = f"%{t}%"
             qs = qs.filter(
                 sa.or_(
-                    cls.audit_log_class.operation.ilike(search),
-                    cls.audit_log_class.entity_type.ilike(search),
-                    cls.audit_log_class.entity_name.ilike(search),
+                    audit_log_class.operation.ilike(search),
+                    audit_log_class.entity_type.ilike(search),
+                    audit_log_class.entity_name.ilike(search),
                     user_cls.first_name.ilike(search),
                     user_cls.last_name.ilike(search),
                 )
             )
         return qs
 
+    @classmethod
+    def get_entry_class(cls, entry_id: str):
+        """
+        Returns the audit log class of an entry and its primary key, from the
+        `entry_id` used in the urls.
+        """
+
+        if not cls.audit_log_class.per_model_tables:
+            return cls.audit_log_class, entry_id
+
+        entity_type, _, item_id = entry_id.rpartition(":")
+        audit_log_class = cls.audit_log_class.model_audit_classes().get(entity_type)
+        if audit_log_class is None:
+            raise HTTPException(404)
+        return audit_log_class, item_id
+
     @classmethod
     async def audit_log_item_view(cls, request):
         if not has_required_scope(request, cls.permission_scopes):
             raise HTTPException(403)
 
-        item_id = request.path_params["item_id"]
-        item = cls.audit_log_class().query.get_or_404(item_id)
+        audit_log_class, item_id = cls.get_entry_class(request.path_params["item_id"])
+        diff_id = request.path_params.get("diff_id")
+        if diff_id is not None:
+            diff_class, diff_id = cls.get_entry_class(diff_id)
+            # entries are compared with those of the same entity, in the same table
+            if diff_class is not audit_log_class:
+                raise HTTPException(404)
 
-        items = item.data_keys
-        extra_items = item.extra_data_keys
+        headers = entry_cache_headers(request, audit_log_class, item_id, diff_id)
+        if is_not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
 
-        diff = None
-        diff_id = request.path_params.get("diff_id")
-        if diff_id:
-            diff = cls.audit_log_class().query.get_or_404(diff_id)
-            items = sorted(list(set(items + diff.data_keys)))
-            extra_items = sorted(list(set(extra_items + diff.extra_data_keys)))
+        item, diff, diff_table = get_entry_diff(
+            request,
+            audit_log_class,
+            item_id,
+            diff_id,
+            cls.diff_template,
+            cls.audit_log_diff_cache,
+        )
 
         context = cls.get_context(request)
-        context.update(
-            {"item": item, "diff": diff, "items": items, "extra_items": extra_items}
-        )
+        context.update({"item": item, "diff": diff, "diff_table": diff_table})
 
-        return config.templates.TemplateResponse(cls.item_template, context)
+        return config.templates.TemplateResponse(
+            cls.item_template, context, headers=headers
+        )
 
     @classmethod
     def url_names(cls):
@@ -0,0 +1,192 @@
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from .tables import HashChainMixin, compute_entry_hash, entry_values, insert_entries
+
+BASELINE = "BASELINE"
+
+
+def chunk_bounds(
+    model_class, bind, chunk_size: int
+) -> typing.List[typing.Tuple[typing.Any, typing.Any]]:
+    """
+    Streams the primary keys of `model_class` with a server side cursor and
+    returns the keyset bounds of every chunk of `chunk_size` rows, as tuples of
+    the exclusive lower and inclusive upper key. The first lower key is `None`.
+    """
+
+    pk = sa.inspect(model_class).primary_key[0]
+
+    bounds = []
+    lower = None
+    with bind.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            sa.select([pk]).order_by(pk)
+        )
+        while True:
+            keys = result.fetchmany(chunk_size)
+            if not keys:
+                break
+            upper = keys[-1][0]
+            bounds.append((lower, upper))
+            lower = upper
+
+    return bounds
+
+
+def unaudited_keys(audit_log_class, connection, entity_type: str, keys: list) -> list:
+    """ Returns the `keys` of the entities that have no entries yet """
+
+    table = audit_log_class.__table__
+    audited = {
+        row.entity_type_id
+        for row in connection.execute(
+            sa.select([table.c.entity_type_id])
+            .where(
+                sa.and_(
+                    table.c.entity_type == entity_type,
+                    table.c.entity_type_id.in_([str(key) for key in keys]),
+                )
+            )
+            .distinct()
+        )
+    }
+    return [key for key in keys if str(key) not in audited]
+
+
+def backfill_chunk(model_class, bind, audit_bind, lower, upper) -> int:
+    """
+    Writes a baseline entry for every row of `model_class` with a primary key
+    after `lower` up to and including `upper` that has no audit history yet,
+    in a single short transaction. Returns the number of entries written.
+
+    The rows of the chunk are locked while their baselines are written, so
+    concurrent changes to them are audited after their baseline. Where the
+    database doesn't lock them, rows that gain an entry while the chunk is
+    being written are skipped as their history has already started.
+    """
+
+    mapper = sa.inspect(model_class)
+    pk = mapper.primary_key[0]
+
+    in_chunk = pk <= upper
+    if lower is not None:
+        in_chunk = sa.and_(pk > lower, in_chunk)
+
+    with bind.begin() as conn:
+        keys = [
+            row[0]
+            for row in conn.execute(
+                sa.select([pk]).where(in_chunk).order_by(pk).with_for_update()
+            )
+        ]
+        if not keys:
+            return 0
+
+        if audit_bind is bind:
+            return write_baselines(model_class, conn, conn, keys)
+
+        with audit_bind.begin() as audit_conn:
+            return write_baselines(model_class, conn, audit_conn, keys)
+
+
+def write_baselines(model_class, connection, audit_connection, keys: list) -> int:
+    """
+    Writes the baseline entries of the rows of `model_class` with the primary
+    `keys` that have no entries. Returns the number of entries written.
+    """
+
+    audit_log_class = model_class.audit_table_class()
+    mapper = sa.inspect(model_class)
+    pk = mapper.primary_key[0]
+    entity_type = model_class.__table__.name
+
+    missing = unaudited_keys(audit_log_class, audit_connection, entity_type, keys)
+    if not missing:
+        return 0
+
+    session = orm.Session(bind=connection)
+    try:
+        rows = [
+            entry_values(mapper, instance, BASELINE)
+            for instance in session.query(model_class)
+            .filter(pk.in_(missing))
+            .order_by(pk)
+        ]
+    finally:
+        session.close()
+
+    # entities changed since they were checked have their history already
+    missing = unaudited_keys(audit_log_class, audit_connection, entity_type, missing)
+    rows = [values for values in rows if values["entity_type_id"] in missing]
+    if not rows:
+        return 0
+
+    if issubclass(audit_log_class, HashChainMixin):
+        # a baseline is always the first entry for its entity
+        for values in rows:
+            values["previous_hash"] = None
+            values["hash"] = compute_entry_hash(None, values)
+
+    insert_entries(audit_connection, audit_log_class, rows)
+    return len(rows)
+
+
+def _backfill_chunk_in_worker(url, audit_url, model_class, lower, upper):
+    engine = sa.create_engine(url)
+    audit_engine = sa.create_engine(audit_url) if audit_url != url else engine
+    try:
+        return backfill_chunk(model_class, engine, audit_engine, lower, upper)
+    finally:
+        engine.dispose()
+        audit_engine.dispose()
+
+
+def backfill_baselines(
+    model_class,
+    bind: sa.engine.Engine,
+    audit_bind: typing.Optional[sa.engine.Engine] = None,
+    chunk_size: int = 1000,
+    workers: int = 1,
+) -> int:
+    """
+    Writes a `BASELINE` audit log entry holding the current state of every
+    existing row of an `Audited` model that has no audit history, so the
+    first change made to it can be compared against something.
+
+    Rows are read from `bind` in keyset chunks of `chunk_size` rows and the
+    entries written through `audit_bind`, defaulting to `bind`. Every chunk
+    runs in its own transaction, in parallel worker processes when there is
+    more than one worker. Rows that already have entries are skipped, so an
+    interrupted backfill is resumed by running it again.
+
+    Returns the number of entries written.
+    """
+
+    if audit_bind is None:
+        audit_bind = bind
+
+    bounds = chunk_bounds(model_class, bind, chunk_size)
+
+    if workers > 1 and len(bounds) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    _backfill_chunk_in_worker,
+                    *zip(
+                        *[
+                            (bind.url, audit_bind.url, model_class, *chunk)
+                            for chunk in bounds
+                        ]
+                    ),
+                )
+            )
+    else:
+        results = [
+            backfill_chunk(model_class, bind, audit_bind, *chunk) for chunk in bounds
+        ]
+
+    return sum(results)
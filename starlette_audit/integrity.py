@@ -0,0 +1,425 @@
+import hashlib
+import hmac
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from .tables import DeduplicatedSnapshotsMixin, compute_entry_hash
+
+
+class ChainVerificationError(Exception):
+    """ Raised when a checkpoint can no longer be trusted """
+
+
+def sign_checkpoint(key: bytes, last_entry_id: int, entry_count: int) -> str:
+    """ Returns the signature of a checkpoint """
+
+    message = f"{last_entry_id}:{entry_count}".encode()
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def sign_chain_head(
+    key: bytes, entity_type: str, entity_type_id: str, entry_id: int, hash: str
+) -> str:
+    """ Returns the signature of the chain head of an entity """
+
+    message = f"{entity_type}:{entity_type_id}:{entry_id}:{hash}".encode()
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def entity_key(entity_type: str, entity_type_id) -> str:
+    """ Returns the key of an entity in a dict of chain heads """
+
+    return f"{entity_type}:{entity_type_id}"
+
+
+def count_entries(audit_log_class, bind, last_entry_id: int, first_id: int = 1) -> int:
+    """ Returns the number of entries from `first_id` up to `last_entry_id` """
+
+    table = audit_log_class.__table__
+    return bind.execute(
+        sa.select([sa.func.count()])
+        .select_from(table)
+        .where(table.c.id.between(first_id, last_entry_id))
+    ).scalar()
+
+
+def latest_entries(
+    audit_log_class, bind, after_id: int, before_id: int, entities=None
+) -> list:
+    """
+    Returns the id, entity and hash of the latest entry of every entity among
+    the entries with an id after `after_id` and before `before_id`. Limited to
+    the entities selected by `entities` when given.
+    """
+
+    table = audit_log_class.__table__
+    latest = table.alias()
+    source = latest
+    if entities is not None:
+        source = latest.join(
+            entities,
+            sa.and_(
+                latest.c.entity_type == entities.c.entity_type,
+                latest.c.entity_type_id == entities.c.entity_type_id,
+            ),
+        )
+    latest_ids = (
+        sa.select([sa.func.max(latest.c.id)])
+        .select_from(source)
+        .where(sa.and_(latest.c.id > after_id, latest.c.id < before_id))
+        .group_by(latest.c.entity_type, latest.c.entity_type_id)
+    )
+    return bind.execute(
+        sa.select(
+            [table.c.id, table.c.entity_type, table.c.entity_type_id, table.c.hash]
+        ).where(table.c.id.in_(latest_ids))
+    ).fetchall()
+
+
+def chain_heads(
+    audit_log_class, bind, after_id: int, before_id: int, entities=None
+) -> typing.Dict[str, str]:
+    """
+    Returns the hashes of `latest_entries`, keyed by `entity_key`.
+    """
+
+    return {
+        entity_key(row.entity_type, row.entity_type_id): row.hash
+        for row in latest_entries(audit_log_class, bind, after_id, before_id, entities)
+    }
+
+
+def entities_between(audit_log_class, first_id: int, last_id: int):
+    """ Selects the entities with entries between `first_id` and `last_id` """
+
+    table = audit_log_class.__table__
+    return (
+        sa.select([table.c.entity_type, table.c.entity_type_id])
+        .where(table.c.id.between(first_id, last_id))
+        .distinct()
+        .alias()
+    )
+
+
+def signed_chain_heads(
+    head_class, bind, key: bytes, entities=None
+) -> typing.Dict[str, str]:
+    """
+    Returns the hashes of the chain heads stored in `head_class`, keyed by
+    `entity_key`, for the entities selected by `entities` or all of them.
+    Raises `ChainVerificationError` when a chain head has an invalid signature.
+    """
+
+    table = head_class.__table__
+    source = table
+    if entities is not None:
+        source = table.join(
+            entities,
+            sa.and_(
+                table.c.entity_type == entities.c.entity_type,
+                table.c.entity_type_id == entities.c.entity_type_id,
+            ),
+        )
+
+    heads = {}
+    for row in bind.execute(sa.select([table]).select_from(source)):
+        signature = sign_chain_head(
+            key, row.entity_type, row.entity_type_id, row.entry_id, row.hash
+        )
+        if not hmac.compare_digest(row.signature, signature):
+            raise ChainVerificationError(
+                f"chain head of {row.entity_type} {row.entity_type_id} "
+                "has an invalid signature"
+            )
+        heads[entity_key(row.entity_type, row.entity_type_id)] = row.hash
+    return heads
+
+
+def verify_chunk(
+    audit_log_class,
+    bind,
+    first_id: int,
+    last_id: int,
+    trusted_heads: typing.Optional[typing.Dict[str, str]] = None,
+    trusted_until: int = 0,
+) -> typing.List[int]:
+    """
+    Verifies the entries with an id between `first_id` and `last_id` inclusive.
+    Each entry must match its own hash and link to the hash of the entry before
+    it for the same entity. Returns the ids of the entries that don't.
+
+    Entries up to `trusted_until` are not read, the hashes of the latest entry
+    of each entity up to there are taken from `trusted_heads` instead.
+    """
+
+    table = audit_log_class.__table__
+    in_chunk = table.c.id.between(first_id, last_id)
+
+    # the hash of the last entry before the chunk for every entity in it
+    entities = entities_between(audit_log_class, first_id, last_id)
+    heads = dict(trusted_heads or {})
+    heads.update(chain_heads(audit_log_class, bind, trusted_until, first_id, entities))
+
+    rows = [
+        dict(row)
+        for row in bind.execute(sa.select([table]).where(in_chunk).order_by(table.c.id))
+    ]
+    if issubclass(audit_log_class, DeduplicatedSnapshotsMixin):
+        load_snapshots(audit_log_class, bind, rows)
+
+    invalid = []
+    for row in rows:
+        entity = entity_key(row["entity_type"], row["entity_type_id"])
+        expected = compute_entry_hash(row["previous_hash"], row)
+        if row["previous_hash"] != heads.get(entity) or row["hash"] != expected:
+            invalid.append(row["id"])
+        heads[entity] = row["hash"]
+
+    return invalid
+
+
+def load_snapshots(audit_log_class, bind, rows: typing.List[dict]) -> None:
+    """ Sets `data` and `extra_data` on rows of a deduplicated audit log """
+
+    table = audit_log_class.snapshot_class().__table__
+    hashes = {row[key] for row in rows for key in ("data_hash", "extra_data_hash")}
+    snapshots = dict(
+        bind.execute(
+            sa.select([table.c.hash, table.c.data]).where(table.c.hash.in_(hashes))
+        ).fetchall()
+    )
+    for row in rows:
+        row["data"] = snapshots.get(row["data_hash"])
+        row["extra_data"] = snapshots.get(row["extra_data_hash"])
+
+
+def _verify_chunk_in_worker(
+    url, audit_log_class, first_id, last_id, trusted_heads, trusted_until
+):
+    engine = sa.create_engine(url)
+    try:
+        return verify_chunk(
+            audit_log_class, engine, first_id, last_id, trusted_heads, trusted_until
+        )
+    finally:
+        engine.dispose()
+
+
+def verify_chain(
+    audit_log_class,
+    bind: sa.engine.Engine,
+    first_id: int = 1,
+    last_id: typing.Optional[int] = None,
+    chunk_size: int = 10000,
+    workers: int = 1,
+    trusted_heads: typing.Optional[typing.Dict[str, str]] = None,
+    trusted_until: int = 0,
+) -> typing.List[int]:
+    """
+    Verifies the entries between `first_id` and `last_id`, or the latest entry,
+    in chunks of `chunk_size` ids. With more than one worker the chunks are
+    verified in parallel worker processes, each with its own connection.
+    Returns the ids of the entries that failed verification.
+
+    `trusted_heads` and `trusted_until` are passed on to `verify_chunk`.
+    """
+
+    if last_id is None:
+        table = audit_log_class.__table__
+        last_id = bind.execute(sa.select([sa.func.max(table.c.id)])).scalar() or 0
+
+    chunks = [
+        (start, min(start + chunk_size - 1, last_id))
+        for start in range(first_id, last_id + 1, chunk_size)
+    ]
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    _verify_chunk_in_worker,
+                    *zip(
+                        *[
+                            (
+                                bind.url,
+                                audit_log_class,
+                                *chunk,
+                                trusted_heads,
+                                trusted_until,
+                            )
+                            for chunk in chunks
+                        ]
+                    ),
+                )
+            )
+    else:
+        results = [
+            verify_chunk(audit_log_class, bind, *chunk, trusted_heads, trusted_until)
+            for chunk in chunks
+        ]
+
+    return [entry_id for invalid in results for entry_id in invalid]
+
+
+def verify_since_checkpoint(
+    audit_log_class,
+    checkpoint_class,
+    bind: sa.engine.Engine,
+    key: bytes,
+    chunk_size: int = 10000,
+    workers: int = 1,
+    grace: timedelta = timedelta(minutes=5),
+    full: bool = False,
+) -> typing.List[int]:
+    """
+    Verifies only the entries added since the latest checkpoint, after checking
+    the checkpoint's signature. New entries have to link to the signed chain
+    heads of their entities, stored in `checkpoint_class.chain_head_class()`.
+    When everything verifies a new checkpoint is stored along with the chain
+    heads of the entities that have new entries.
+
+    Entries up to the checkpoint are trusted. With `full` they are verified
+    again as well, and their number and the latest entry of every entity are
+    checked against the checkpoint and the signed chain heads.
+
+    The new checkpoint only covers entries created more than `grace` ago, as
+    transactions still open may commit entries with an id before the latest
+    one. `grace` should exceed the longest running transaction writing entries.
+
+    Returns the ids of the entries that failed verification and raises
+    `ChainVerificationError` if the checkpoint itself can't be trusted.
+    """
+
+    checkpoints = checkpoint_class.__table__
+    head_class = checkpoint_class.chain_head_class()
+    checkpoint = bind.execute(
+        sa.select([checkpoints]).order_by(sa.desc(checkpoints.c.id)).limit(1)
+    ).first()
+
+    first_id = 1
+    entry_count = 0
+    if checkpoint:
+        signature = sign_checkpoint(
+            key, checkpoint.last_entry_id, checkpoint.entry_count
+        )
+        if not hmac.compare_digest(checkpoint.signature, signature):
+            raise ChainVerificationError("checkpoint signature is invalid")
+
+        first_id = checkpoint.last_entry_id + 1
+        entry_count = checkpoint.entry_count
+
+        if full:
+            count = count_entries(audit_log_class, bind, checkpoint.last_entry_id)
+            if count != entry_count:
+                raise ChainVerificationError(
+                    f"expected {entry_count} entries up to the checkpoint, "
+                    f"found {count}"
+                )
+            heads = chain_heads(audit_log_class, bind, 0, first_id)
+            if heads != signed_chain_heads(head_class, bind, key):
+                raise ChainVerificationError(
+                    "entries up to the checkpoint no longer match the chain heads"
+                )
+
+    table = audit_log_class.__table__
+    last_id = bind.execute(sa.select([sa.func.max(table.c.id)])).scalar() or 0
+
+    if full:
+        invalid = verify_chain(audit_log_class, bind, 1, last_id, chunk_size, workers)
+    else:
+        trusted_heads = signed_chain_heads(
+            head_class, bind, key, entities_between(audit_log_class, first_id, last_id)
+        )
+        invalid = verify_chain(
+            audit_log_class,
+            bind,
+            first_id,
+            last_id,
+            chunk_size,
+            workers,
+            trusted_heads,
+            first_id - 1,
+        )
+
+    checkpoint_id = (
+        bind.execute(
+            sa.select([sa.func.max(table.c.id)]).where(
+                sa.and_(
+                    table.c.id <= last_id,
+                    table.c.created_on < datetime.utcnow() - grace,
+                )
+            )
+        ).scalar()
+        or 0
+    )
+
+    if not invalid and checkpoint_id >= first_id:
+        store_checkpoint(
+            audit_log_class,
+            checkpoint_class,
+            bind,
+            key,
+            first_id,
+            checkpoint_id,
+            entry_count + count_entries(audit_log_class, bind, checkpoint_id, first_id),
+        )
+
+    return invalid
+
+
+def store_checkpoint(
+    audit_log_class,
+    checkpoint_class,
+    bind: sa.engine.Engine,
+    key: bytes,
+    first_id: int,
+    last_id: int,
+    entry_count: int,
+) -> None:
+    """
+    Stores a checkpoint at `last_id` and replaces the chain heads of the
+    entities with entries from `first_id` on, in a single transaction.
+    """
+
+    heads = checkpoint_class.chain_head_class().__table__
+    rows = [
+        {
+            "entity_type": row.entity_type,
+            "entity_type_id": row.entity_type_id,
+            "entry_id": row.id,
+            "hash": row.hash,
+            "signature": sign_chain_head(
+                key, row.entity_type, row.entity_type_id, row.id, row.hash
+            ),
+        }
+        for row in latest_entries(audit_log_class, bind, first_id - 1, last_id + 1)
+    ]
+
+    with bind.begin() as conn:
+        if rows:
+            conn.execute(
+                heads.delete().where(
+                    sa.and_(
+                        heads.c.entity_type == sa.bindparam("b_entity_type"),
+                        heads.c.entity_type_id == sa.bindparam("b_entity_type_id"),
+                    )
+                ),
+                [
+                    {
+                        "b_entity_type": row["entity_type"],
+                        "b_entity_type_id": row["entity_type_id"],
+                    }
+                    for row in rows
+                ],
+            )
+            conn.execute(heads.insert(), rows)
+        conn.execute(
+            checkpoint_class.__table__.insert().values(
+                last_entry_id=last_id,
+                entry_count=entry_count,
+                signature=sign_checkpoint(key, last_id, entry_count),
+            )
+        )
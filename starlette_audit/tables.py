@@ -1,3 +1,8 @@
+import atexit
+import hashlib
+import json
+import logging
+import threading
 import typing
 from datetime import date, datetime
 from decimal import Decimal
@@ -6,9 +11,24 @@ from uuid import UUID
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.sql.expression import cast
+from starlette_core.database import Session
 from starlette_core.middleware import get_request
 
+try:
+    from sqlalchemy.ext.asyncio import AsyncEngine
+except ImportError:  # pragma: nocover
+    AsyncEngine = None  # type: ignore
+
+try:
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+except ImportError:  # pragma: nocover
+    sqlite_insert = None
+
+logger = logging.getLogger(__name__)
+
 
 class AuditLogMixin:
     """
@@ -40,12 +60,70 @@ class AuditLogMixin:
     created_by_id = None
     created_by = None
 
+    # set on an abstract audit log class to generate a table from it for every
+    # audited model, see `Audited.audit_table_class`
+    per_model_tables: bool = False
+
     @property
     def audited_instance(self):
         """ Instance the audit log item belongs too """
 
         return getattr(self, "audited_instance_%s" % self.entity_type)
 
+    @property
+    def entry_id(self):
+        """
+        Identifies the entry in `AuditLogAdmin`, including the entity type when
+        entries are spread over per model tables.
+        """
+
+        if self.per_model_tables:
+            return "%s:%s" % (self.entity_type, self.id)
+        return str(self.id)
+
+    @classmethod
+    def model_audit_classes(cls) -> typing.Dict[str, typing.Any]:
+        """
+        Returns the classes generated from a `per_model_tables` audit log class,
+        keyed by the entity type of their model.
+        """
+
+        return dict(_model_audit_classes.get(cls, {}))
+
+    @classmethod
+    def load_audited_instances(cls, entries: typing.List["AuditLogMixin"]) -> None:
+        """
+        Loads `.audited_instance` for a list of entries using a single `IN` query
+        per entity type rather than one lazy load per entry. Entries whose
+        instance no longer exists get `None`.
+        """
+
+        grouped: typing.Dict[str, typing.List["AuditLogMixin"]] = {}
+        for entry in entries:
+            grouped.setdefault(entry.entity_type, []).append(entry)
+
+        for entity_type, group in grouped.items():
+            key = "audited_instance_%s" % entity_type
+            entry_class = type(group[0])
+            audited_class = sa.inspect(entry_class).relationships[key].mapper.class_
+            pk = sa.inspect(audited_class).primary_key[0]
+
+            ids = {entry.entity_type_id for entry in group}
+            try:
+                values = [pk.type.python_type(i) for i in ids]
+            except NotImplementedError:
+                values = list(ids)
+
+            instances = {
+                str(instance.id): instance
+                for instance in audited_class.query.filter(pk.in_(values))
+            }
+
+            for entry in group:
+                orm.attributes.set_committed_value(
+                    entry, key, instances.get(entry.entity_type_id)
+                )
+
     @property
     def data_keys(self):
         """ Returns a list of the keys in `self.data` """
@@ -58,25 +136,643 @@ class AuditLogMixin:
 
         return sorted(self.extra_data.keys())
 
+    @classmethod
+    def latest_state_class(cls) -> typing.Optional["LatestStateMixin"]:
+        """
+        Can return a subclass of `LatestStateMixin` to keep the latest state of
+        every audited entity in its own table.
+        """
+
+        return None
+
+    @classmethod
+    def last_known_state(cls, entity_type, entity_type_id):
+        """
+        Returns the latest state of an entity, including a deleted one, or `None`.
+        Read from the latest state table if there is one, otherwise from the
+        latest audit log entry.
+        """
+
+        latest_state_class = cls.latest_state_class()
+        if latest_state_class is not None:
+            return latest_state_class.query.filter_by(
+                entity_type=entity_type, entity_type_id=str(entity_type_id)
+            ).first()
+
+        return (
+            cls.query.filter_by(
+                entity_type=entity_type, entity_type_id=str(entity_type_id)
+            )
+            .order_by(sa.desc(cls.created_on))
+            .first()
+        )
+
+    @classmethod
+    def deleted_entity_ids(cls, entity_type):
+        """
+        Returns the ids of the entities of `entity_type` whose last known state
+        is a deletion, ie those that can be restored.
+        """
+
+        latest_state_class = cls.latest_state_class()
+        if latest_state_class is not None:
+            query = latest_state_class.query.filter_by(
+                entity_type=entity_type, operation="DELETE"
+            ).with_entities(latest_state_class.entity_type_id)
+        else:
+            later = orm.aliased(cls)
+            query = cls.query.filter(
+                cls.entity_type == entity_type,
+                cls.operation == "DELETE",
+                ~sa.exists().where(
+                    sa.and_(
+                        later.entity_type == cls.entity_type,
+                        later.entity_type_id == cls.entity_type_id,
+                        later.created_on > cls.created_on,
+                    )
+                ),
+            ).with_entities(cls.entity_type_id)
+
+        return {entity_type_id for entity_type_id, in query}
+
+    @classmethod
+    def without_payload(cls):
+        """
+        Query option that only loads the columns needed to list entries,
+        deferring the `data` and `extra_data` payloads until they are accessed.
+        """
+
+        return orm.load_only(
+            "id",
+            "entity_type",
+            "entity_type_id",
+            "entity_name",
+            "operation",
+            "created_on",
+            "created_by_id",
+        )
+
+    def later_records_criteria(self):
+        cls = self.__class__
+        return (
+            cls.entity_type == self.entity_type,
+            cls.entity_type_id == self.entity_type_id,
+            cls.created_on > self.created_on,
+        )
+
+    def prior_records_criteria(self):
+        cls = self.__class__
+        return (
+            cls.entity_type == self.entity_type,
+            cls.entity_type_id == self.entity_type_id,
+            cls.created_on < self.created_on,
+        )
+
     @property
     def later_records(self):
         """ Returns all audit log entries after to this record """
 
-        return self.__class__.query.filter(
-            self.__class__.entity_type == self.entity_type,
-            self.__class__.entity_type_id == self.entity_type_id,
-            self.__class__.created_on > self.created_on,
-        ).order_by(sa.desc(self.__class__.created_on))
+        return (
+            self.__class__.query.options(self.without_payload())
+            .filter(*self.later_records_criteria())
+            .order_by(sa.desc(self.__class__.created_on))
+        )
 
     @property
     def prior_records(self):
         """ Returns all audit log entries prior to this record """
 
-        return self.__class__.query.filter(
-            self.__class__.entity_type == self.entity_type,
-            self.__class__.entity_type_id == self.entity_type_id,
-            self.__class__.created_on < self.created_on,
-        ).order_by(sa.desc(self.__class__.created_on))
+        return (
+            self.__class__.query.options(self.without_payload())
+            .filter(*self.prior_records_criteria())
+            .order_by(sa.desc(self.__class__.created_on))
+        )
+
+    @classmethod
+    def payload_options(cls) -> list:
+        """
+        Query options that load the `data` and `extra_data` payloads along with
+        the entries, for sessions that can't load them lazily.
+        """
+
+        if issubclass(cls, DeduplicatedSnapshotsMixin):
+            return [
+                orm.selectinload(cls.data_snapshot),
+                orm.selectinload(cls.extra_data_snapshot),
+            ]
+        return []
+
+    async def fetch_later_records(self, session, with_payload: bool = True) -> list:
+        """
+        Returns `later_records` using an `AsyncSession`, including their payloads
+        unless `with_payload` is `False`.
+        """
+
+        return await self._fetch_records(
+            session, self.later_records_criteria(), with_payload
+        )
+
+    async def fetch_prior_records(self, session, with_payload: bool = True) -> list:
+        """
+        Returns `prior_records` using an `AsyncSession`, including their payloads
+        unless `with_payload` is `False`.
+        """
+
+        return await self._fetch_records(
+            session, self.prior_records_criteria(), with_payload
+        )
+
+    async def _fetch_records(self, session, criteria, with_payload: bool) -> list:
+        cls = self.__class__
+        options = cls.payload_options() if with_payload else [cls.without_payload()]
+        result = await session.execute(
+            sa.select(cls)
+            .options(*options)
+            .filter(*criteria)
+            .order_by(sa.desc(cls.created_on))
+        )
+        return result.scalars().all()
+
+
+class AuditSnapshotMixin:
+    """
+    A mixin class for the content addressed table that stores the `data` and
+    `extra_data` of a `DeduplicatedSnapshotsMixin` audit log, keyed by hash.
+
+    class AuditSnapshot(AuditSnapshotMixin, Base):
+        pass
+    """
+
+    hash = sa.Column(sa.String(64), nullable=False, unique=True)
+    data = sa.Column(sa.types.JSON)
+
+
+class DeduplicatedSnapshotsMixin:
+    """
+    Optional mixin for the audit log class that stores `data` and `extra_data`
+    in a snapshot table, so identical payloads are only stored once. Entries
+    reference their snapshots by hash and `.data` and `.extra_data` read and
+    assign as before, assigned payloads are stored when the entry is flushed.
+    Must come before `AuditLogMixin`:
+
+    class AuditLog(DeduplicatedSnapshotsMixin, AuditLogMixin, Base):
+        @classmethod
+        def snapshot_class(cls):
+            return AuditSnapshot
+    """
+
+    data_hash = sa.Column(sa.String(64), nullable=True)
+    extra_data_hash = sa.Column(sa.String(64), nullable=True)
+
+    @classmethod
+    def snapshot_class(cls) -> "AuditSnapshotMixin":
+        """
+        Should return the snapshot class, a subclass of `AuditSnapshotMixin`.
+        """
+
+        raise NotImplementedError("should return the snapshot class")
+
+    @declared_attr
+    def data_snapshot(cls):
+        snapshot_class = cls.snapshot_class()
+        return orm.relationship(
+            snapshot_class,
+            primaryjoin=lambda: orm.foreign(cls.data_hash) == snapshot_class.hash,
+            viewonly=True,
+        )
+
+    @declared_attr
+    def extra_data_snapshot(cls):
+        snapshot_class = cls.snapshot_class()
+        return orm.relationship(
+            snapshot_class,
+            primaryjoin=lambda: orm.foreign(cls.extra_data_hash) == snapshot_class.hash,
+            viewonly=True,
+        )
+
+    @property
+    def data(self):
+        return self.get_snapshot_data("data")
+
+    @data.setter
+    def data(self, value):
+        self.set_snapshot_data("data", value)
+
+    @property
+    def extra_data(self):
+        return self.get_snapshot_data("extra_data")
+
+    @extra_data.setter
+    def extra_data(self, value):
+        self.set_snapshot_data("extra_data", value)
+
+    def get_snapshot_data(self, key: str):
+        pending = self.__dict__.get("_pending_snapshots", {})
+        if key in pending:
+            return pending[key]
+
+        snapshot = getattr(self, f"{key}_snapshot")
+        return snapshot.data if snapshot else None
+
+    def set_snapshot_data(self, key: str, value) -> None:
+        self.__dict__.setdefault("_pending_snapshots", {})[key] = value
+        setattr(self, f"{key}_hash", snapshot_hash(value))
+        # unload a previously loaded snapshot, it no longer matches the hash
+        self.__dict__.pop(f"{key}_snapshot", None)
+
+
+def snapshot_hash(data) -> str:
+    """ Returns the content address of a snapshot """
+
+    content = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def store_snapshots(connection, snapshot_class, snapshots: dict) -> None:
+    """
+    Stores the `snapshots`, a dict of hash to data, that are not already
+    stored. Snapshots stored concurrently by another transaction are ignored.
+    """
+
+    table = snapshot_class.__table__
+    existing = {
+        row.hash
+        for row in connection.execute(
+            sa.select([table.c.hash]).where(table.c.hash.in_(list(snapshots)))
+        )
+    }
+    missing = [
+        {"hash": hash, "data": data}
+        for hash, data in snapshots.items()
+        if hash not in existing
+    ]
+    if not missing:
+        return
+
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        insert = postgresql.insert(table).on_conflict_do_nothing(
+            index_elements=[table.c.hash]
+        )
+    elif dialect == "sqlite":
+        insert = table.insert().prefix_with("OR IGNORE")
+    elif dialect == "mysql":
+        insert = table.insert().prefix_with("IGNORE")
+    else:
+        insert = table.insert()
+    connection.execute(insert, missing)
+
+
+@sa.event.listens_for(DeduplicatedSnapshotsMixin, "before_insert", propagate=True)
+@sa.event.listens_for(DeduplicatedSnapshotsMixin, "before_update", propagate=True)
+def receive_before_flush_snapshots(mapper, connection, target):
+    # left on the entry, where `data` and `extra_data` keep reading them from
+    pending = target.__dict__.get("_pending_snapshots")
+    if pending:
+        store_snapshots(
+            connection,
+            mapper.class_.snapshot_class(),
+            {snapshot_hash(value): value for value in pending.values()},
+        )
+
+
+class LatestStateMixin:
+    """
+    A mixin class for a table holding the last known state of every audited
+    entity, including deleted ones. Kept up to date as entries are written.
+
+    class AuditLatestState(LatestStateMixin, Base):
+        pass
+
+    class AuditLog(AuditLogMixin, Base):
+        @classmethod
+        def latest_state_class(cls):
+            return AuditLatestState
+    """
+
+    entity_type = sa.Column(sa.String(255), nullable=False)
+    entity_type_id = sa.Column(sa.String(50), nullable=False)
+    entity_name = sa.Column(sa.String(255), nullable=False)
+    operation = sa.Column(sa.String(10), nullable=False)
+    updated_on = sa.Column(sa.DateTime, nullable=False)
+    entry_count = sa.Column(sa.Integer, nullable=False, default=0)
+    data = sa.Column(sa.types.JSON)
+    extra_data = sa.Column(sa.types.JSON)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (sa.UniqueConstraint("entity_type", "entity_type_id"),)
+
+
+def latest_state_upsert(dialect: str, table: sa.Table):
+    """
+    Returns an insert of latest states that updates the row already stored for
+    an entity instead, adding to its entry count. `None` when the dialect has
+    no upsert.
+    """
+
+    columns = ["entity_name", "operation", "updated_on", "data", "extra_data"]
+
+    if dialect == "mysql":
+        insert = mysql.insert(table)
+        return insert.on_duplicate_key_update(
+            entry_count=table.c.entry_count + insert.inserted.entry_count,
+            **{column: insert.inserted[column] for column in columns},
+        )
+
+    if dialect == "postgresql":
+        insert = postgresql.insert(table)
+    elif dialect == "sqlite" and sqlite_insert is not None:
+        insert = sqlite_insert(table)
+    else:
+        return None
+
+    return insert.on_conflict_do_update(
+        index_elements=[table.c.entity_type, table.c.entity_type_id],
+        set_=dict(
+            entry_count=table.c.entry_count + insert.excluded.entry_count,
+            **{column: insert.excluded[column] for column in columns},
+        ),
+    )
+
+
+def update_latest_states(
+    connection, latest_state_class, rows: typing.List[dict]
+) -> None:
+    """
+    Updates the latest state of the entities of newly written entries, with a
+    single upsert where the dialect supports it.
+    """
+
+    table = latest_state_class.__table__
+
+    latest: typing.Dict[tuple, typing.Tuple[dict, int]] = {}
+    for row in rows:
+        entity = (row["entity_type"], str(row["entity_type_id"]))
+        count = latest[entity][1] + 1 if entity in latest else 1
+        latest[entity] = (row, count)
+
+    states = [
+        {
+            "entity_type": entity_type,
+            "entity_type_id": entity_type_id,
+            "entity_name": row["entity_name"],
+            "operation": row["operation"],
+            "updated_on": row["created_on"],
+            "entry_count": count,
+            "data": row["data"],
+            "extra_data": row["extra_data"],
+        }
+        for (entity_type, entity_type_id), (row, count) in latest.items()
+    ]
+
+    upsert = latest_state_upsert(connection.dialect.name, table)
+    if upsert is not None:
+        connection.execute(upsert, states)
+        return
+
+    # without an upsert, concurrent writers of a new entity can conflict
+    for values in states:
+        entity_type = values.pop("entity_type")
+        entity_type_id = values.pop("entity_type_id")
+        count = values.pop("entry_count")
+        result = connection.execute(
+            table.update()
+            .where(
+                sa.and_(
+                    table.c.entity_type == entity_type,
+                    table.c.entity_type_id == entity_type_id,
+                )
+            )
+            .values(entry_count=table.c.entry_count + count, **values)
+        )
+        if result.rowcount == 0:
+            connection.execute(
+                table.insert().values(
+                    entity_type=entity_type,
+                    entity_type_id=entity_type_id,
+                    entry_count=count,
+                    **values,
+                )
+            )
+
+
+def insert_entries(connection, audit_log_class, rows: typing.List[dict]) -> None:
+    """
+    Inserts entries of `audit_log_class`, first moving their `data` and
+    `extra_data` to the snapshot table if it deduplicates them. Updates the
+    latest state table if there is one.
+    """
+
+    latest_state_class = audit_log_class.latest_state_class()
+    if latest_state_class is not None:
+        update_latest_states(connection, latest_state_class, rows)
+
+    if issubclass(audit_log_class, DeduplicatedSnapshotsMixin):
+        snapshots = {}
+        deduplicated = []
+        for row in rows:
+            row = row.copy()
+            for key in ("data", "extra_data"):
+                value = row.pop(key)
+                row[f"{key}_hash"] = snapshot_hash(value)
+                snapshots[row[f"{key}_hash"]] = value
+            deduplicated.append(row)
+        store_snapshots(connection, audit_log_class.snapshot_class(), snapshots)
+        rows = deduplicated
+
+    connection.execute(audit_log_class.__table__.insert(), rows)
+
+
+@sa.event.listens_for(AuditLogMixin, "after_insert", propagate=True)
+def receive_after_insert_latest_state(mapper, connection, target):
+    # entries added through the session, others are written by `insert_entries`
+    latest_state_class = mapper.class_.latest_state_class()
+    if latest_state_class is not None:
+        values = {
+            key: getattr(target, key)
+            for key in (
+                "entity_type",
+                "entity_type_id",
+                "entity_name",
+                "operation",
+                "created_on",
+                "data",
+                "extra_data",
+            )
+        }
+        update_latest_states(connection, latest_state_class, [values])
+
+
+class HashChainMixin:
+    """
+    Optional mixin for the audit log class that makes it tamper evident.
+    Each entry stores the hash of the entry before it for the same entity, so
+    changing or removing an entry breaks the chain. Verified using the functions
+    in `starlette_audit.integrity`.
+
+    Entries are linked while the change is flushed, where the row lock taken on
+    the audited row keeps concurrent changes to an entity in order. Because of
+    that, it can't be combined with `use_write_bind`. Entries added through the
+    session are linked as they are inserted.
+
+    `created_on` is part of the hash, it keeps its microseconds on MySQL.
+    Must come before `AuditLogMixin`:
+
+    class AuditLog(HashChainMixin, AuditLogMixin, Base):
+        ...
+    """
+
+    previous_hash = sa.Column(sa.String(64), nullable=True)
+    hash = sa.Column(sa.String(64), nullable=True)
+    created_on = sa.Column(
+        sa.DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"),
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class AuditCheckpointMixin:
+    """
+    A mixin class for storing signed checkpoints of a hash chained audit log.
+    Everything up to the latest checkpoint has been verified, allowing
+    verification to continue from there.
+
+    class AuditCheckpoint(AuditCheckpointMixin, Base):
+        @classmethod
+        def chain_head_class(cls):
+            return AuditChainHead
+    """
+
+    last_entry_id = sa.Column(sa.Integer, nullable=False)
+    entry_count = sa.Column(sa.Integer, nullable=False)
+    created_on = sa.Column(sa.DateTime, nullable=False, default=datetime.utcnow)
+    signature = sa.Column(sa.String(64), nullable=False)
+
+    @classmethod
+    def chain_head_class(cls) -> "AuditChainHeadMixin":
+        """
+        Should return the chain head class, a subclass of `AuditChainHeadMixin`.
+        """
+
+        raise NotImplementedError("should return the chain head class")
+
+
+class AuditChainHeadMixin:
+    """
+    A mixin class for the signed hash of the latest entry of every entity as of
+    the latest checkpoint, which entries added after it have to link to.
+
+    class AuditChainHead(AuditChainHeadMixin, Base):
+        pass
+    """
+
+    entity_type = sa.Column(sa.String(255), nullable=False)
+    entity_type_id = sa.Column(sa.String(50), nullable=False)
+    entry_id = sa.Column(sa.Integer, nullable=False)
+    hash = sa.Column(sa.String(64), nullable=False)
+    signature = sa.Column(sa.String(64), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (sa.UniqueConstraint("entity_type", "entity_type_id"),)
+
+
+def compute_entry_hash(previous_hash: typing.Optional[str], values) -> str:
+    """
+    Returns the hash of an entry, `values` being the dict of values written
+    or a row read back from the database.
+    """
+
+    content = json.dumps(
+        [
+            previous_hash,
+            values["entity_type"],
+            str(values["entity_type_id"]),
+            values["entity_name"],
+            values["operation"],
+            values["created_on"].isoformat(),
+            values["created_by_id"],
+            values["data"],
+            values["extra_data"],
+        ],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def chain_entry(audit_log_class, values: dict, bind, heads=None) -> None:
+    """
+    Sets `previous_hash` and `hash` on the values of a new entry, reading the
+    hash of the latest entry for the same entity through `bind`.
+
+    `heads` can hold the hashes of entries linked but not inserted yet, keyed
+    by entity, and is updated with the new entry.
+    """
+
+    entity = (values["entity_type"], str(values["entity_type_id"]))
+
+    if heads is not None and entity in heads:
+        previous_hash = heads[entity]
+    else:
+        table = audit_log_class.__table__
+        previous_hash = bind.execute(
+            sa.select([table.c.hash])
+            .where(
+                sa.and_(
+                    table.c.entity_type == entity[0],
+                    table.c.entity_type_id == entity[1],
+                )
+            )
+            .order_by(sa.desc(table.c.id))
+            .limit(1)
+        ).scalar()
+
+    values["previous_hash"] = previous_hash
+    values["hash"] = compute_entry_hash(previous_hash, values)
+
+    if heads is not None:
+        heads[entity] = values["hash"]
+
+
+# key in `session.info` holding the hashes of entries linked during a flush
+CHAIN_HEADS_KEY = "starlette_audit_chain_heads"
+
+
+@sa.event.listens_for(HashChainMixin, "before_insert", propagate=True)
+def receive_before_insert_chain(mapper, connection, target):
+    # entries added through the session, ie with `manage_audit_manually`
+    if target.hash is not None:
+        return
+
+    if target.created_on is None:
+        target.created_on = datetime.utcnow()
+
+    values = {
+        key: getattr(target, key)
+        for key in (
+            "entity_type",
+            "entity_type_id",
+            "entity_name",
+            "operation",
+            "created_on",
+            "created_by_id",
+            "data",
+            "extra_data",
+        )
+    }
+    session = orm.object_session(target)
+    heads = session.info.setdefault(CHAIN_HEADS_KEY, {})
+    chain_entry(mapper.class_, values, connection, heads.setdefault(mapper.class_, {}))
+
+    target.previous_hash = values["previous_hash"]
+    target.hash = values["hash"]
+
+
+@sa.event.listens_for(orm.Session, "after_flush")
+def receive_after_flush_chain(session, flush_context):
+    session.info.pop(CHAIN_HEADS_KEY, None)
 
 
 class Audited:
@@ -109,6 +805,71 @@ class Audited:
 
         raise NotImplementedError("should return the audit log class")
 
+    @classmethod
+    def audit_table_class(cls):
+        """
+        Returns the audit log class entries of this model are stored in. When
+        `audit_class` has `per_model_tables` set it is generated from it on first
+        use, with a table named after the model's table.
+        """
+
+        audit_log_class = cls.audit_class()
+        if not audit_log_class.per_model_tables:
+            return audit_log_class
+
+        assert audit_log_class.__dict__.get(
+            "__abstract__"
+        ), f"{audit_log_class} should be abstract to use per model tables"
+
+        entity_type = cls.__table__.name
+        classes = _model_audit_classes.setdefault(audit_log_class, {})
+        if entity_type not in classes:
+            classes[entity_type] = type(
+                cls.__name__ + audit_log_class.__name__,
+                (audit_log_class,),
+                {
+                    "__module__": cls.__module__,
+                    "__tablename__": "%s_%s"
+                    % (entity_type, audit_log_class.__name__.lower()),
+                },
+            )
+        return classes[entity_type]
+
+    @classmethod
+    def restore_deleted(cls, entity_id):
+        """
+        Returns a new, unsaved, instance of a deleted entity built from its last
+        known state or `None` if the entity is not deleted.
+        """
+
+        state = cls.audit_table_class().last_known_state(cls.__table__.name, entity_id)
+        if state is None or state.operation != "DELETE":
+            return None
+
+        values = {}
+        for key, column in cls.__mapper__.columns.items():
+            if key in state.data:
+                values[key] = restore_value(column, state.data[key])
+
+        return cls(**values)
+
+    async def fetch_auditlog(self, session) -> list:
+        """
+        Loads `instance.auditlog` using an `AsyncSession`, after which it can be
+        accessed without emitting any further queries.
+        """
+
+        audit_log_class = self.audit_table_class()
+        result = await session.execute(
+            sa.select(audit_log_class)
+            .options(*audit_log_class.payload_options())
+            .filter(orm.with_parent(self, "auditlog"))
+            .order_by(sa.desc(audit_log_class.created_on))
+        )
+        entries = result.scalars().all()
+        orm.attributes.set_committed_value(self, "auditlog", entries)
+        return entries
+
     def audit_data(self):
         """ Returns a dict of data to store in the audit log """
 
@@ -172,6 +933,49 @@ class Audited:
         return data_dict
 
 
+def restore_value(column: sa.Column, value):
+    """ Reverses the conversion made by `Audited.audit_data` for a column """
+
+    if value is None:
+        return None
+
+    enum_class = getattr(column.type, "enum_class", None)
+    if enum_class is not None:
+        return enum_class[value]
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    elif python_type is date:
+        return date.fromisoformat(value)
+    elif python_type in (Decimal, UUID):
+        return python_type(value)
+    return value
+
+
+_model_audit_classes: typing.Dict[type, typing.Dict[str, typing.Any]] = {}
+
+# audited models mapped since the mappers were last configured
+_unconfigured_models: typing.List[typing.Any] = []
+
+
+@sa.event.listens_for(Audited, "instrument_class", propagate=True)
+def receive_instrument_class(mapper, class_):
+    _unconfigured_models.append(class_)
+
+
+@sa.event.listens_for(orm.Mapper, "before_configured")
+def receive_before_configured():
+    # per model audit log classes have to be mapped before the mappers are
+    # configured for them to be configured along with the audited models
+    while _unconfigured_models:
+        _unconfigured_models.pop().audit_table_class()
+
+
 @sa.event.listens_for(Audited, "mapper_configured", propagate=True)
 def setup_listener(mapper, class_):
     """
@@ -181,7 +985,7 @@ def setup_listener(mapper, class_):
     of the audit log entry.
     """
 
-    audit_log_class = class_.audit_class()
+    audit_log_class = class_.audit_table_class()
 
     assert issubclass(
         audit_log_class, AuditLogMixin
@@ -204,31 +1008,397 @@ def setup_listener(mapper, class_):
     )
 
 
+_read_binds: typing.Dict[type, sa.engine.Connectable] = {}
+
+
+def get_read_bind(audit_log_class):
+    """
+    Returns the read bind of `audit_log_class`, or of the audit log class it
+    was generated from. Snapshots and latest states are read through the bind
+    of the audit log class they belong to.
+    """
+
+    for class_ in audit_log_class.__mro__:
+        if class_ in _read_binds:
+            return _read_binds[class_]
+
+    for class_, bind in _read_binds.items():
+        owned = [class_.latest_state_class()]
+        if issubclass(class_, DeduplicatedSnapshotsMixin):
+            owned.append(class_.snapshot_class())
+        if any(c is not None and issubclass(audit_log_class, c) for c in owned):
+            return bind
+    return None
+
+
+class ReadBindSession(orm.Session):
+    """
+    Session that routes queries of audit log classes to their read bind. Flushes
+    use the session's own binds, so entries added to the session are written in
+    the same transaction as everything else.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if mapper is not None and not self._flushing:
+            bind = get_read_bind(sa.inspect(mapper).class_)
+            if bind is not None:
+                return bind
+        return super().get_bind(mapper, clause, **kw)
+
+
+def use_read_bind(
+    audit_log_class: typing.Type[AuditLogMixin],
+    bind: typing.Optional[sa.engine.Connectable],
+) -> None:
+    """
+    Routes all reads of `audit_log_class` through `bind`, ie an engine connected
+    to a read replica or a separate reporting database. This covers the admin
+    views as well as `instance.auditlog`, `.prior_records` and `.later_records`,
+    the snapshots of a `DeduplicatedSnapshotsMixin` audit log and its latest
+    state table.
+
+    Entries are still written through the connection of the business transaction,
+    including entries added to the session with `manage_audit_manually`, as the
+    sessions of `starlette_core.database.Session` become a `ReadBindSession`.
+    Sessions created elsewhere need to use `ReadBindSession` themselves.
+    Passing `None` as the `bind` restores reads to the default engine.
+
+    Should be called once on startup, after `starlette_core.database.Database`
+    has been created:
+
+    db = Database(url)
+    use_read_bind(AuditLog, sa.create_engine(replica_url))
+    """
+
+    if bind is None:
+        _read_binds.pop(audit_log_class, None)
+    else:
+        _read_binds[audit_log_class] = bind
+
+    session_class = Session.session_factory.class_
+    if not issubclass(session_class, ReadBindSession):
+        Session.session_factory.class_ = type(
+            session_class.__name__, (ReadBindSession, session_class), {}
+        )
+
+
+_write_binds: typing.Dict[type, sa.engine.Engine] = {}
+
+# key in `session.info` holding the entries waiting for the session to commit
+PENDING_ENTRIES_KEY = "starlette_audit_pending_entries"
+
+# key in `session.info` holding the entries of the changes being flushed
+FLUSHED_ENTRIES_KEY = "starlette_audit_flushed_entries"
+
+# entries that could not be written to their write bind, held for a retry
+# along with the number of times they failed while the write bind was up
+_unwritten_entries: typing.List[typing.Tuple[typing.Any, dict, int]] = []
+_unwritten_lock = threading.Lock()
+
+# an entry failing this often is dropped, eg one violating a constraint
+MAX_WRITE_ATTEMPTS = 5
+
+# the most entries held for a retry, the oldest are dropped beyond it
+MAX_UNWRITTEN_ENTRIES = 10000
+
+
+def use_write_bind(
+    audit_log_class: typing.Type[AuditLogMixin],
+    bind: typing.Optional[sa.engine.Engine],
+) -> None:
+    """
+    Writes entries of `audit_log_class` through `bind`, an engine with its own
+    connection pool, ie a dedicated audit database.
+
+    Entries are collected for the duration of the session's transaction and are
+    written in a single batch once it has committed. They are discarded if the
+    transaction, or the savepoint they were made in, is rolled back or the
+    session is closed without committing.
+
+    The batch is written after the audited changes have committed. When the
+    write fails the error is logged and the entries are held in memory for a
+    retry after the next batch, see `retry_unwritten_entries`, which also runs
+    when the process exits. Entries that can't be written are logged in full
+    when they are dropped.
+
+    Passing `None` as the `bind` restores writing entries in the same transaction
+    as the change being audited. Not supported for a `HashChainMixin` audit log,
+    whose entries have to be linked in that transaction. Usually combined with
+    `use_read_bind`:
+
+    audit_engine = sa.create_engine(audit_url)
+    use_write_bind(AuditLog, audit_engine)
+    use_read_bind(AuditLog, audit_engine)
+    """
+
+    if AsyncEngine is not None and isinstance(bind, AsyncEngine):
+        # writes happen within the session's commit, which an `AsyncSession`
+        # runs in a greenlet where the sync facade of the engine can be used
+        bind = bind.sync_engine
+
+    if bind is None:
+        _write_binds.pop(audit_log_class, None)
+        return
+
+    # two sessions changing an entity would both link to the same head, as
+    # entries are only written once the session has committed
+    assert not issubclass(
+        audit_log_class, HashChainMixin
+    ), f"{audit_log_class} is hash chained and can't use a write bind"
+
+    _write_binds[audit_log_class] = bind
+
+
+def get_write_bind(audit_log_class):
+    """
+    Returns the write bind of `audit_log_class`, or of the audit log class it
+    was generated from.
+    """
+
+    for class_ in audit_log_class.__mro__:
+        if class_ in _write_binds:
+            return _write_binds[class_]
+    return None
+
+
+def entry_values(mapper, target, operation: str, user_id=None) -> dict:
+    """ Returns the values of a new audit log entry for `target` """
+
+    # ensure entity name is no longer than 255 chars
+    target_str = str(target)
+    entity_name = (target_str[:253] + "..") if len(target_str) > 253 else target_str
+
+    return {
+        "entity_type": mapper.class_.__table__.name,
+        "entity_type_id": target.id,
+        "entity_name": entity_name,
+        "operation": operation,
+        "created_on": datetime.utcnow(),
+        "created_by_id": user_id,
+        "data": target.audit_data(),
+        "extra_data": target.audit_extra_data(),
+    }
+
+
 def add_auditlog_entry(mapper, connection, target, operation):
     request = get_request()
     user_id = None
     if request and "user" in request:
         user_id = getattr(request["user"], "id")
 
-    # ensure entity name is no longer than 255 chars
-    target_str = str(target)
-    entity_name = (target_str[:253] + "..") if len(target_str) > 253 else target_str
+    audit_log_class = mapper.relationships["auditlog"].mapper.class_
+    values = entry_values(mapper, target, operation, user_id)
 
-    connection.execute(
-        mapper.relationships["auditlog"]
-        .target.insert()
-        .values(
-            {
-                "entity_type": mapper.class_.__table__.name,
-                "entity_type_id": target.id,
-                "entity_name": entity_name,
-                "operation": operation,
-                "created_by_id": user_id,
-                "data": target.audit_data(),
-                "extra_data": target.audit_extra_data(),
-            }
+    if get_write_bind(audit_log_class) is not None:
+        session = orm.object_session(target)
+        pending = session.info.setdefault(PENDING_ENTRIES_KEY, [])
+        pending.append(
+            (_transaction_boundary(session.transaction), audit_log_class, values)
         )
-    )
+        return
+
+    session = orm.object_session(target)
+    flushed = session.info.setdefault(FLUSHED_ENTRIES_KEY, [])
+    flushed.append((connection, audit_log_class, values))
+
+
+def write_flushed_entries(entries: typing.List[typing.Tuple[typing.Any, ...]]) -> None:
+    """
+    Writes the entries collected by `add_auditlog_entry` during a flush through
+    the connection of the audited changes, one `executemany` per audit log class.
+    """
+
+    grouped: typing.Dict[tuple, typing.List[dict]] = {}
+    for connection, audit_log_class, values in entries:
+        grouped.setdefault((connection, audit_log_class), []).append(values)
+
+    for (connection, audit_log_class), rows in grouped.items():
+        if issubclass(audit_log_class, HashChainMixin):
+            heads: typing.Dict[tuple, str] = {}
+            for values in rows:
+                chain_entry(audit_log_class, values, connection, heads)
+
+        insert_entries(connection, audit_log_class, rows)
+
+
+def write_entries(audit_log_class, rows: typing.List[dict], log: bool = True) -> bool:
+    """
+    Writes `rows` to the write bind of `audit_log_class` in a single
+    transaction. Returns whether they were written.
+    """
+
+    try:
+        with get_write_bind(audit_log_class).begin() as conn:
+            insert_entries(conn, audit_log_class, rows)
+    except Exception:
+        if log:
+            logger.exception(
+                "Could not write %d %s entries, keeping them for a retry",
+                len(rows),
+                audit_log_class.__name__,
+            )
+        return False
+    return True
+
+
+def drop_entries(reason: str, entries) -> None:
+    """ Logs the values of entries that won't be written, so they can be recovered """
+
+    for audit_log_class, values, _ in entries:
+        logger.error(
+            "Dropping %s entry %s: %s",
+            audit_log_class.__name__,
+            reason,
+            json.dumps(values, default=str, sort_keys=True),
+        )
+
+
+def write_pending_entries(entries: typing.List[typing.Tuple[typing.Any, dict]]) -> None:
+    """
+    Writes entries collected by `add_auditlog_entry` to their write bind,
+    one `executemany` per audit log class.
+
+    As the audited changes are already committed, a failing write bind does
+    not raise. The error is logged and the entries are kept in memory for a
+    retry after the next batch, or by `retry_unwritten_entries`.
+
+    Entries held for a retry are written apart from the new ones, and one at a
+    time when their batch fails, so a single entry that can't be written holds
+    back no other. It is dropped after failing `MAX_WRITE_ATTEMPTS` times.
+    """
+
+    with _unwritten_lock:
+        unwritten = _unwritten_entries[:]
+        del _unwritten_entries[:]
+
+    grouped: typing.Dict[typing.Any, typing.List[dict]] = {}
+    for audit_log_class, values in entries:
+        grouped.setdefault(audit_log_class, []).append(values)
+
+    failed: typing.List[typing.Tuple[typing.Any, dict, int]] = []
+    written = set()
+    for audit_log_class, rows in grouped.items():
+        if write_entries(audit_log_class, rows):
+            written.add(audit_log_class)
+        else:
+            failed.extend((audit_log_class, row, 0) for row in rows)
+
+    retries: typing.Dict[typing.Any, list] = {}
+    for entry in unwritten:
+        retries.setdefault(entry[0], []).append(entry)
+
+    for audit_log_class, retry in retries.items():
+        if write_entries(audit_log_class, [values for _, values, _ in retry], False):
+            continue
+
+        results = [
+            (entry, write_entries(audit_log_class, [entry[1]], False))
+            for entry in retry
+        ]
+        if audit_log_class not in written and not any(ok for _, ok in results):
+            # nothing could be written, the write bind is most likely down
+            failed.extend(retry)
+            continue
+
+        for (_, values, attempts), ok in results:
+            if ok:
+                continue
+            if attempts + 1 >= MAX_WRITE_ATTEMPTS:
+                drop_entries(
+                    f"after {attempts + 1} failed writes",
+                    [(audit_log_class, values, attempts + 1)],
+                )
+            else:
+                failed.append((audit_log_class, values, attempts + 1))
+
+    with _unwritten_lock:
+        _unwritten_entries.extend(failed)
+        overflow = len(_unwritten_entries) - MAX_UNWRITTEN_ENTRIES
+        if overflow > 0:
+            drop_entries(
+                "as too many are held for a retry", _unwritten_entries[:overflow]
+            )
+            del _unwritten_entries[:overflow]
+
+
+def retry_unwritten_entries() -> int:
+    """
+    Writes the entries a write bind previously failed to write. Returns the
+    number of entries still unwritten.
+    """
+
+    if _unwritten_entries:
+        write_pending_entries([])
+    return len(_unwritten_entries)
+
+
+@atexit.register
+def receive_exit() -> None:
+    # a last retry, whatever is still unwritten is logged so it isn't lost
+    if retry_unwritten_entries():
+        with _unwritten_lock:
+            drop_entries("as the process exits", _unwritten_entries)
+            del _unwritten_entries[:]
+
+
+def _transaction_boundary(transaction):
+    # flushes run in subtransactions, entries belong to the transaction
+    # or savepoint that will actually be committed or rolled back
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    return transaction
+
+
+@sa.event.listens_for(orm.Session, "before_flush")
+def receive_before_flush(session, flush_context, instances):
+    # entries of a flush that failed were rolled back along with it
+    session.info.pop(FLUSHED_ENTRIES_KEY, None)
+
+
+@sa.event.listens_for(orm.Session, "after_flush")
+def receive_after_flush(session, flush_context):
+    flushed = session.info.pop(FLUSHED_ENTRIES_KEY, None)
+    if flushed:
+        write_flushed_entries(flushed)
+
+
+@sa.event.listens_for(orm.Session, "after_commit")
+def receive_after_commit(session):
+    pending = session.info.get(PENDING_ENTRIES_KEY)
+    if not pending:
+        return
+
+    transaction = session.transaction
+    if transaction.nested:
+        # a released savepoint hands its entries to the enclosing transaction
+        parent = _transaction_boundary(transaction.parent)
+        session.info[PENDING_ENTRIES_KEY] = [
+            (parent if tx is transaction else tx, cls, values)
+            for tx, cls, values in pending
+        ]
+        return
+
+    del session.info[PENDING_ENTRIES_KEY]
+    write_pending_entries([(cls, values) for _, cls, values in pending])
+
+
+@sa.event.listens_for(orm.Session, "after_transaction_end")
+def receive_after_transaction_end(session, transaction):
+    pending = session.info.get(PENDING_ENTRIES_KEY)
+    if not pending:
+        return
+
+    if transaction.parent is None:
+        # whatever is left once the outermost transaction has ended was rolled
+        # back or discarded, eg by `session.close()`, committed entries are
+        # already written by `receive_after_commit`
+        del session.info[PENDING_ENTRIES_KEY]
+        return
+
+    # a savepoint that ended without being released was rolled back
+    session.info[PENDING_ENTRIES_KEY] = [
+        entry for entry in pending if entry[0] is not transaction
+    ]
 
 
 @sa.event.listens_for(Audited, "after_insert", propagate=True)
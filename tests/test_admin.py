@@ -0,0 +1,304 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as sa
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette_admin import config
+
+from starlette_audit.admin import (
+    AuditedModelAdmin,
+    AuditLogAdmin,
+    DiffCache,
+    entry_cache_headers,
+    is_not_modified,
+)
+
+from .test_tables import (
+    AuditLog,
+    MyModel,
+    OtherShardedModel,
+    ShardedAuditLog,
+    ShardedModel,
+    StateModel,
+)
+
+HEADERS = {
+    "ETag": '"abc"',
+    "Last-Modified": "Mon, 19 Oct 2026 10:00:00 GMT",
+    "Cache-Control": "private, no-cache",
+}
+
+
+class AuditAdmin(AuditLogAdmin):
+    audit_log_class = AuditLog
+
+
+class ShardedAuditAdmin(AuditLogAdmin):
+    audit_log_class = ShardedAuditLog
+    audit_log_limit_records = 3
+
+    @classmethod
+    def get_context(cls, request):
+        return {}
+
+
+class MyModelAdmin(AuditedModelAdmin):
+    model_class = MyModel
+
+    @classmethod
+    def get_context(cls, request):
+        return {}
+
+    @classmethod
+    def url_names(cls):
+        return {"list": "mymodel_list"}
+
+
+class StateModelAdmin(MyModelAdmin):
+    model_class = StateModel
+
+
+@pytest.fixture
+def templates(monkeypatch):
+    # renders the context of a template response
+    monkeypatch.setattr(
+        config,
+        "templates",
+        SimpleNamespace(
+            TemplateResponse=lambda template, context, **kwargs: context,
+            get_template=lambda template: SimpleNamespace(render=lambda context: ""),
+        ),
+    )
+
+
+def make_request(headers=None, **path_params):
+    return SimpleNamespace(
+        headers=Headers(headers or {}),
+        path_params=path_params,
+        url_for=lambda name, **params: f"/{name}",
+        user=SimpleNamespace(is_authenticated=True, display_name="admin"),
+        auth=SimpleNamespace(scopes=["authenticated"]),
+    )
+
+
+def test_diff_cache():
+    cache = DiffCache(maxsize=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+
+    # reading an item makes it the most recently used
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert len(cache.items) == 2
+
+
+def test_is_not_modified_etag():
+    assert is_not_modified(make_request({"if-none-match": '"abc"'}), HEADERS)
+    assert is_not_modified(make_request({"if-none-match": '"x", "abc"'}), HEADERS)
+    assert is_not_modified(make_request({"if-none-match": 'W/"abc"'}), HEADERS)
+    assert is_not_modified(make_request({"if-none-match": "*"}), HEADERS)
+    assert not is_not_modified(make_request({"if-none-match": '"x"'}), HEADERS)
+
+    # if-none-match takes precedence over if-modified-since
+    request = make_request(
+        {"if-none-match": '"x"', "if-modified-since": HEADERS["Last-Modified"]}
+    )
+    assert not is_not_modified(request, HEADERS)
+
+
+def test_is_not_modified_since():
+    assert is_not_modified(
+        make_request({"if-modified-since": "Mon, 19 Oct 2026 10:00:00 GMT"}), HEADERS
+    )
+    assert is_not_modified(
+        make_request({"if-modified-since": "Tue, 20 Oct 2026 10:00:00 GMT"}), HEADERS
+    )
+    assert not is_not_modified(
+        make_request({"if-modified-since": "Sun, 18 Oct 2026 10:00:00 GMT"}), HEADERS
+    )
+    assert not is_not_modified(make_request({"if-modified-since": "never"}), HEADERS)
+    assert not is_not_modified(make_request(), HEADERS)
+
+
+def test_item_view_not_modified(db):
+    db.create_all()
+
+    obj = MyModel(name="foo")
+    obj.save()
+    obj.name = "bar"
+    obj.save()
+
+    entry = AuditLog.query.order_by(AuditLog.id).first()
+    item_id = str(entry.id)
+    headers = entry_cache_headers(make_request(), AuditLog, item_id, None)
+
+    queries = []
+
+    def count_query(*args):
+        queries.append(args)
+
+    request = make_request({"if-none-match": headers["ETag"]}, item_id=item_id)
+
+    sa.event.listen(db.engine, "before_cursor_execute", count_query)
+    try:
+        response = asyncio.run(AuditAdmin.audit_log_item_view(request))
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", count_query)
+
+    # answered from the validators alone, without loading any entries
+    assert response.status_code == 304
+    assert response.headers["etag"] == headers["ETag"]
+    assert len(queries) == 1
+
+    # a newer entry for the entity changes the validators
+    obj.name = "baz"
+    obj.save()
+
+    assert not is_not_modified(
+        request, entry_cache_headers(request, AuditLog, item_id, None)
+    )
+
+
+@pytest.mark.parametrize("admin", [MyModelAdmin, StateModelAdmin])
+def test_deleted_view(db, templates, admin):
+    db.create_all()
+
+    restored = admin.model_class(name="foo")
+    restored.save()
+    deleted = admin.model_class(name="bar")
+    deleted.save()
+    restored_id, deleted_id = str(restored.id), str(deleted.id)
+    restored.delete()
+    deleted.delete()
+
+    request = make_request(entity_id=restored_id)
+    response = asyncio.run(admin.audit_log_restore_view(request))
+    assert response.status_code == 302
+    assert response.headers["location"] == "/mymodel_list"
+    assert admin.model_class.query.get(int(restored_id)).name == "foo"
+
+    # only entities that are still deleted can be restored
+    context = asyncio.run(admin.audit_log_deleted_view(make_request()))
+    assert len(context["list_objects"]) == 2
+    assert context["restorable_ids"] == {deleted_id}
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(admin.audit_log_restore_view(request))
+    assert exc_info.value.status_code == 404
+
+
+def test_restore_view_conflict(db, templates):
+    db.create_all()
+
+    obj = StateModel(name="foo")
+    obj.save()
+    id = obj.id
+    obj.delete()
+
+    # the id has since been taken by a row the audit log doesn't know about
+    with db.engine.begin() as conn:
+        conn.execute(StateModel.__table__.insert().values(id=id, name="other"))
+
+    request = make_request(entity_id=str(id))
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(StateModelAdmin.audit_log_restore_view(request))
+    assert exc_info.value.status_code == 409
+
+    # the session was rolled back and is still usable
+    assert StateModel.query.get(id).name == "other"
+
+
+def create_sharded_history(db):
+    foo = ShardedModel(name="foo")
+    foo.save()
+    OtherShardedModel(name="bar").save()
+    foo.name = "baz"
+    foo.save()
+    OtherShardedModel(name="qux").save()
+
+    # entries of both tables interleave, two of them at the same time
+    classes = ShardedAuditLog.model_audit_classes()
+    times = {
+        ("shardedmodel", 1): datetime(2026, 1, 1),
+        ("othershardedmodel", 1): datetime(2026, 1, 3),
+        ("shardedmodel", 2): datetime(2026, 1, 3),
+        ("othershardedmodel", 2): datetime(2026, 1, 2),
+    }
+    with db.engine.begin() as conn:
+        for (entity_type, id), created_on in times.items():
+            table = classes[entity_type].__table__
+            conn.execute(
+                table.update().where(table.c.id == id).values(created_on=created_on)
+            )
+
+
+def test_merged_list_objects(db):
+    db.create_all()
+
+    assert ShardedAuditAdmin.get_merged_list_objects("") == []
+
+    create_sharded_history(db)
+
+    # the latest entries of all tables, newest first and limited
+    entries = ShardedAuditAdmin.get_merged_list_objects("")
+    assert [entry.entry_id for entry in entries] == [
+        "shardedmodel:2",
+        "othershardedmodel:1",
+        "othershardedmodel:2",
+    ]
+
+
+def test_merged_list_objects_search(db):
+    db.create_all()
+
+    create_sharded_history(db)
+
+    entries = ShardedAuditAdmin.get_merged_list_objects("insert")
+    assert [entry.entry_id for entry in entries] == [
+        "othershardedmodel:1",
+        "othershardedmodel:2",
+        "shardedmodel:1",
+    ]
+
+    entries = ShardedAuditAdmin.get_merged_list_objects("update shardedmodel")
+    assert [entry.entry_id for entry in entries] == ["shardedmodel:2"]
+
+    assert ShardedAuditAdmin.get_merged_list_objects("nothing") == []
+
+
+def test_get_entry_class(db):
+    classes = ShardedAuditLog.model_audit_classes()
+
+    assert ShardedAuditAdmin.get_entry_class("shardedmodel:2") == (
+        classes["shardedmodel"],
+        "2",
+    )
+    assert AuditAdmin.get_entry_class("2") == (AuditLog, "2")
+
+    with pytest.raises(HTTPException) as exc_info:
+        ShardedAuditAdmin.get_entry_class("unknown:2")
+    assert exc_info.value.status_code == 404
+
+
+def test_sharded_item_view(db, templates):
+    db.create_all()
+
+    create_sharded_history(db)
+
+    request = make_request(item_id="shardedmodel:2", diff_id="shardedmodel:1")
+    context = asyncio.run(ShardedAuditAdmin.audit_log_item_view(request))
+    assert context["item"].entry_id == "shardedmodel:2"
+    assert context["diff"].entry_id == "shardedmodel:1"
+
+    # a diff with an entry of another table doesn't pick the same id in this one
+    request = make_request(item_id="shardedmodel:2", diff_id="othershardedmodel:1")
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(ShardedAuditAdmin.audit_log_item_view(request))
+    assert exc_info.value.status_code == 404
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+import sqlalchemy as sa
+from starlette_core.database import metadata
+
+from starlette_audit.tables import use_write_bind
+
+from .test_tables import AuditLog, DedupAuditLog, DedupModel, MyModel
+
+asyncio_ext = pytest.importorskip("sqlalchemy.ext.asyncio")
+pytest.importorskip("aiosqlite")
+
+
+async def create_engine(path):
+    engine = asyncio_ext.create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    return engine
+
+
+def test_async_session(tmp_path):
+    async def run():
+        engine = await create_engine(tmp_path / "db.sqlite3")
+
+        async with asyncio_ext.AsyncSession(engine, expire_on_commit=False) as session:
+            obj = MyModel(name="foo")
+            session.add(obj)
+            await session.commit()
+
+            obj.name = "bar"
+            await session.commit()
+
+            obj.name = "baz"
+            await session.commit()
+
+            entries = await obj.fetch_auditlog(session)
+            assert [entry.operation for entry in entries] == [
+                "UPDATE",
+                "UPDATE",
+                "INSERT",
+            ]
+            assert entries[1].data == {"id": obj.id, "name": "bar"}
+            assert obj.auditlog == entries
+
+            prior = await entries[1].fetch_prior_records(session)
+            later = await entries[1].fetch_later_records(session)
+            assert prior == [entries[2]]
+            assert later == [entries[0]]
+
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_async_records_payload(tmp_path):
+    async def run():
+        engine = await create_engine(tmp_path / "db.sqlite3")
+
+        async with asyncio_ext.AsyncSession(engine) as session:
+            for model in (MyModel, DedupModel):
+                obj = model(name="foo")
+                session.add(obj)
+                await session.commit()
+                obj.name = "bar"
+                await session.commit()
+                obj.name = "baz"
+                await session.commit()
+
+        # entries not in the identity map yet have their payloads loaded
+        for audit_log_class in (AuditLog, DedupAuditLog):
+            async with asyncio_ext.AsyncSession(engine) as session:
+                entry = await session.get(audit_log_class, 2)
+                prior = await entry.fetch_prior_records(session)
+                later = await entry.fetch_later_records(session)
+                assert prior[0].data == {"id": 1, "name": "foo"}
+                assert later[0].data == {"id": 1, "name": "baz"}
+
+        async with asyncio_ext.AsyncSession(engine) as session:
+            entry = await session.get(AuditLog, 2)
+            prior = await entry.fetch_prior_records(session, with_payload=False)
+            assert prior[0].id == 1
+            assert "data" not in prior[0].__dict__
+
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_async_write_bind(tmp_path):
+    async def run():
+        engine = await create_engine(tmp_path / "db.sqlite3")
+        audit_engine = await create_engine(tmp_path / "audit.sqlite3")
+
+        use_write_bind(AuditLog, audit_engine)
+
+        try:
+            async with asyncio_ext.AsyncSession(engine) as session:
+                session.add(MyModel(name="foo"))
+                session.add(MyModel(name="bar"))
+                await session.commit()
+        finally:
+            use_write_bind(AuditLog, None)
+
+        count = sa.select([sa.func.count()]).select_from(AuditLog.__table__)
+        async with engine.connect() as conn:
+            assert (await conn.execute(count)).scalar() == 0
+        async with audit_engine.connect() as conn:
+            assert (await conn.execute(count)).scalar() == 2
+
+        await engine.dispose()
+        await audit_engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,112 @@
+import sqlalchemy as sa
+from sqlalchemy import orm
+from starlette_core.database import metadata
+
+from starlette_audit import backfill
+from starlette_audit.backfill import backfill_baselines
+from starlette_audit.integrity import verify_chain
+
+from .test_integrity import ChainedAuditLog, ChainedModel
+from .test_tables import AuditLog, MyModel
+
+
+def create_engine(path):
+    engine = sa.create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    return engine
+
+
+def entries(engine, audit_log_class):
+    table = audit_log_class.__table__
+    return engine.execute(sa.select([table]).order_by(table.c.id)).fetchall()
+
+
+def test_backfill(tmp_path):
+    engine = create_engine(tmp_path / "db.sqlite3")
+    engine.execute(
+        MyModel.__table__.insert(), [{"name": f"name {i}"} for i in range(5)]
+    )
+
+    assert backfill_baselines(MyModel, engine, chunk_size=2) == 5
+
+    rows = entries(engine, AuditLog)
+    assert [row.operation for row in rows] == ["BASELINE"] * 5
+    assert [row.entity_type_id for row in rows] == ["1", "2", "3", "4", "5"]
+    assert rows[0].entity_type == "mymodel"
+    assert rows[0].data == {"id": 1, "name": "name 0"}
+
+    # rows that already have entries are skipped
+    assert backfill_baselines(MyModel, engine, chunk_size=2) == 0
+
+    # resumes from where an interrupted backfill stopped
+    table = AuditLog.__table__
+    engine.execute(table.delete().where(table.c.id > 3))
+    engine.execute(MyModel.__table__.insert(), [{"name": "name 5"}])
+
+    assert backfill_baselines(MyModel, engine, chunk_size=2) == 3
+    assert [row.entity_type_id for row in entries(engine, AuditLog)] == [
+        "1",
+        "2",
+        "3",
+        "4",
+        "5",
+        "6",
+    ]
+
+
+def test_backfill_audit_bind(tmp_path):
+    engine = create_engine(tmp_path / "db.sqlite3")
+    audit_engine = create_engine(tmp_path / "audit.sqlite3")
+    engine.execute(
+        MyModel.__table__.insert(), [{"name": f"name {i}"} for i in range(3)]
+    )
+
+    assert backfill_baselines(MyModel, engine, audit_engine) == 3
+
+    assert entries(engine, AuditLog) == []
+    assert len(entries(audit_engine, AuditLog)) == 3
+
+
+def test_backfill_in_workers(tmp_path):
+    engine = create_engine(tmp_path / "db.sqlite3")
+    engine.execute(
+        ChainedModel.__table__.insert(), [{"name": f"name {i}"} for i in range(7)]
+    )
+
+    assert backfill_baselines(ChainedModel, engine, chunk_size=2, workers=2) == 7
+
+    rows = entries(engine, ChainedAuditLog)
+    assert sorted(int(row.entity_type_id) for row in rows) == list(range(1, 8))
+    assert all(row.previous_hash is None for row in rows)
+    assert verify_chain(ChainedAuditLog, engine) == []
+
+
+def test_backfill_concurrent_update(tmp_path, monkeypatch):
+    engine = create_engine(tmp_path / "db.sqlite3")
+    engine.execute(
+        ChainedModel.__table__.insert(), [{"name": f"name {i}"} for i in range(3)]
+    )
+
+    entry_values = backfill.entry_values
+
+    def update_first(mapper, target, operation, user_id=None):
+        # the row is changed by a live write while its baseline is prepared
+        if target.id == 1 and target.name == "name 0":
+            session = orm.Session(bind=engine)
+            obj = session.query(ChainedModel).get(1)
+            obj.name = "live"
+            session.commit()
+            session.close()
+        return entry_values(mapper, target, operation, user_id)
+
+    monkeypatch.setattr(backfill, "entry_values", update_first)
+
+    assert backfill_baselines(ChainedModel, engine) == 2
+
+    rows = entries(engine, ChainedAuditLog)
+    assert [(row.entity_type_id, row.operation) for row in rows] == [
+        ("1", "UPDATE"),
+        ("2", "BASELINE"),
+        ("3", "BASELINE"),
+    ]
+    assert verify_chain(ChainedAuditLog, engine) == []
@@ -0,0 +1,401 @@
+from datetime import timedelta
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateTable
+from starlette_auth.tables import User
+from starlette_core.database import Base, Session, metadata
+
+from starlette_audit.integrity import (
+    ChainVerificationError,
+    verify_chain,
+    verify_since_checkpoint,
+)
+from starlette_audit.tables import (
+    AuditChainHeadMixin,
+    AuditCheckpointMixin,
+    Audited,
+    AuditLogMixin,
+    AuditSnapshotMixin,
+    DeduplicatedSnapshotsMixin,
+    HashChainMixin,
+    compute_entry_hash,
+    snapshot_hash,
+    use_write_bind,
+)
+
+KEY = b"secret"
+
+NO_GRACE = timedelta(0)
+
+
+class ChainedAuditLog(HashChainMixin, AuditLogMixin, Base):
+    created_by_id = sa.Column(sa.Integer, sa.ForeignKey(User.id), nullable=True)
+    created_by = orm.relationship(User)
+
+
+class AuditChainHead(AuditChainHeadMixin, Base):
+    pass
+
+
+class AuditCheckpoint(AuditCheckpointMixin, Base):
+    @classmethod
+    def chain_head_class(cls):
+        return AuditChainHead
+
+
+class ChainedModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return ChainedAuditLog
+
+
+class ChainedSnapshot(AuditSnapshotMixin, Base):
+    pass
+
+
+class DedupChainedAuditLog(
+    HashChainMixin, DeduplicatedSnapshotsMixin, AuditLogMixin, Base
+):
+    created_by_id = sa.Column(sa.Integer, sa.ForeignKey(User.id), nullable=True)
+    created_by = orm.relationship(User)
+
+    @classmethod
+    def snapshot_class(cls):
+        return ChainedSnapshot
+
+
+class DedupChainedModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return DedupChainedAuditLog
+
+
+def tamper(db, entry_id, **values):
+    with db.engine.begin() as conn:
+        conn.execute(
+            ChainedAuditLog.__table__.update()
+            .where(ChainedAuditLog.__table__.c.id == entry_id)
+            .values(**values)
+        )
+
+
+def rewrite(db, entry_id, **values):
+    """ Changes an entry and re-hashes the chain of its entity from there on """
+
+    table = ChainedAuditLog.__table__
+    with db.engine.begin() as conn:
+        entry = conn.execute(sa.select([table]).where(table.c.id == entry_id)).first()
+        rows = conn.execute(
+            sa.select([table])
+            .where(
+                sa.and_(
+                    table.c.entity_type == entry.entity_type,
+                    table.c.entity_type_id == entry.entity_type_id,
+                    table.c.id >= entry_id,
+                )
+            )
+            .order_by(table.c.id)
+        ).fetchall()
+
+        previous_hash = entry.previous_hash
+        for row in rows:
+            row = dict(row)
+            if row["id"] == entry_id:
+                row.update(values)
+            row["previous_hash"] = previous_hash
+            row["hash"] = compute_entry_hash(previous_hash, row)
+            conn.execute(table.update().where(table.c.id == row["id"]).values(**row))
+            previous_hash = row["hash"]
+
+
+def sweep(db, key=KEY, **kwargs):
+    return verify_since_checkpoint(
+        ChainedAuditLog, AuditCheckpoint, db.engine, key, **kwargs
+    )
+
+
+def create_history():
+    foo = ChainedModel(name="foo")
+    foo.save()
+    bar = ChainedModel(name="bar")
+    bar.save()
+    foo.name = "baz"
+    foo.save()
+    foo.delete()
+
+
+def test_entries_are_chained(db):
+    db.create_all()
+
+    create_history()
+
+    foo_logs = ChainedAuditLog.query.filter_by(entity_type_id="1").all()
+    bar_logs = ChainedAuditLog.query.filter_by(entity_type_id="2").all()
+
+    assert [log.operation for log in foo_logs] == ["INSERT", "UPDATE", "DELETE"]
+    assert foo_logs[0].previous_hash is None
+    assert foo_logs[1].previous_hash == foo_logs[0].hash
+    assert foo_logs[2].previous_hash == foo_logs[1].hash
+    assert bar_logs[0].previous_hash is None
+
+    assert verify_chain(ChainedAuditLog, db.engine) == []
+
+
+def test_detects_tampering(db):
+    db.create_all()
+
+    create_history()
+
+    # changed data no longer matches the hash
+    tamper(db, 1, data={"id": 1, "name": "other"})
+    assert verify_chain(ChainedAuditLog, db.engine, chunk_size=2) == [1]
+
+    # rehashing the changed entry breaks the link from the next one
+    tamper(db, 1, hash="0" * 64)
+    assert verify_chain(ChainedAuditLog, db.engine, chunk_size=2) == [1, 3]
+
+
+def test_verify_since_checkpoint(db):
+    db.create_all()
+
+    create_history()
+
+    assert sweep(db, grace=NO_GRACE) == []
+    checkpoint = AuditCheckpoint.query.one()
+    assert checkpoint.last_entry_id == 4
+    assert checkpoint.entry_count == 4
+    assert {
+        (head.entity_type_id, head.entry_id, head.hash) for head in AuditChainHead.query
+    } == {
+        ("1", 4, ChainedAuditLog.query.get(4).hash),
+        ("2", 2, ChainedAuditLog.query.get(2).hash),
+    }
+
+    # only entries after the checkpoint are verified
+    tamper(db, 1, data={"id": 1, "name": "other"})
+    ChainedModel(name="qux").save()
+    tamper(db, 5, data={"id": 3, "name": "other"})
+
+    assert sweep(db, grace=NO_GRACE) == [5]
+    assert verify_chain(ChainedAuditLog, db.engine) == [1, 5]
+
+    # unless the full log is verified again
+    assert sweep(db, grace=NO_GRACE, full=True) == [1, 5]
+
+
+def test_verify_since_checkpoint_untrusted(db):
+    db.create_all()
+
+    create_history()
+
+    sweep(db, grace=NO_GRACE)
+
+    with pytest.raises(ChainVerificationError):
+        sweep(db, key=b"wrong")
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            ChainedAuditLog.__table__.delete().where(
+                ChainedAuditLog.__table__.c.id == 2
+            )
+        )
+
+    # the entries up to the checkpoint are trusted, unless checked in full
+    assert sweep(db) == []
+
+    with pytest.raises(ChainVerificationError):
+        sweep(db, full=True)
+
+
+def test_verify_since_checkpoint_tampered_head(db):
+    db.create_all()
+
+    create_history()
+
+    sweep(db, grace=NO_GRACE)
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            AuditChainHead.__table__.update()
+            .where(AuditChainHead.__table__.c.entity_type_id == "2")
+            .values(hash="0" * 64)
+        )
+
+    bar = ChainedModel.query.get(2)
+    bar.name = "qux"
+    bar.save()
+
+    with pytest.raises(ChainVerificationError):
+        sweep(db)
+
+
+def test_verify_since_checkpoint_rehashed(db):
+    db.create_all()
+
+    create_history()
+
+    sweep(db, grace=NO_GRACE)
+
+    # the chain is consistent again, but no longer has the signed heads
+    rewrite(db, 1, data={"id": 1, "name": "other"})
+    assert verify_chain(ChainedAuditLog, db.engine) == []
+
+    with pytest.raises(ChainVerificationError):
+        sweep(db, full=True)
+
+
+def test_verify_since_checkpoint_links_to_signed_heads(db):
+    db.create_all()
+
+    create_history()
+
+    sweep(db, grace=NO_GRACE)
+
+    bar = ChainedModel.query.get(2)
+    bar.name = "qux"
+    bar.save()
+
+    # entries after the checkpoint link to its heads, not to those in the table
+    rewrite(db, 2, data={"id": 2, "name": "other"})
+    assert verify_chain(ChainedAuditLog, db.engine) == []
+    assert sweep(db) == [5]
+
+    with pytest.raises(ChainVerificationError):
+        sweep(db, full=True)
+
+
+def test_checkpoint_grace(db):
+    db.create_all()
+
+    create_history()
+
+    # entries of the last minutes might still be joined by open transactions
+    assert sweep(db) == []
+    assert AuditCheckpoint.query.count() == 0
+
+    long_ago = ChainedAuditLog.query.get(1).created_on - timedelta(hours=1)
+    rewrite(db, 1, created_on=long_ago)
+    rewrite(db, 2, created_on=long_ago)
+
+    assert sweep(db) == []
+    checkpoint = AuditCheckpoint.query.one()
+    assert checkpoint.last_entry_id == 2
+    assert checkpoint.entry_count == 2
+
+    # the remaining entries are covered by the next sweep
+    assert sweep(db, grace=NO_GRACE) == []
+    assert (
+        AuditCheckpoint.query.order_by(AuditCheckpoint.id.desc()).first().last_entry_id
+        == 4
+    )
+
+
+def test_manual_entries_are_chained(db):
+    db.create_all()
+
+    session = Session()
+    for operation in ("INSERT", "UPDATE"):
+        session.add(
+            ChainedAuditLog(
+                entity_type="chainedmodel",
+                entity_type_id="1",
+                entity_name="foo",
+                operation=operation,
+                data={"id": 1, "name": operation},
+                extra_data={},
+            )
+        )
+    session.commit()
+
+    first, second = ChainedAuditLog.query.order_by(ChainedAuditLog.id).all()
+    assert first.previous_hash is None
+    assert second.previous_hash == first.hash
+    assert verify_chain(ChainedAuditLog, db.engine) == []
+
+    Session.remove()
+
+
+def test_created_on_precision():
+    # the microseconds of `created_on` are part of the hash
+    ddl = str(CreateTable(ChainedAuditLog.__table__).compile(dialect=mysql.dialect()))
+    assert "created_on DATETIME(6) NOT NULL" in ddl
+
+
+def test_entries_chained_per_flush(db):
+    db.create_all()
+
+    create_history()
+
+    # entries of a flush are linked before being inserted together
+    session = Session()
+    foo, bar = ChainedModel(name="foo"), ChainedModel.query.get(2)
+    bar.name = "qux"
+    session.add(foo)
+    session.commit()
+
+    update = (
+        ChainedAuditLog.query.filter_by(entity_type_id="2")
+        .order_by(sa.desc(ChainedAuditLog.id))
+        .first()
+    )
+    assert update.previous_hash == ChainedAuditLog.query.get(2).hash
+    assert verify_chain(ChainedAuditLog, db.engine) == []
+
+    Session.remove()
+
+
+def test_no_write_bind(db):
+    # entries linked before the session commits could fork the chain
+    with pytest.raises(AssertionError):
+        use_write_bind(ChainedAuditLog, sa.create_engine("sqlite://"))
+
+
+def test_verify_in_workers(db, tmp_path):
+    db.create_all()
+
+    create_history()
+
+    engine = sa.create_engine(f"sqlite:///{tmp_path}/audit.db")
+    metadata.create_all(engine)
+
+    table = ChainedAuditLog.__table__
+    with db.engine.connect() as conn:
+        rows = [dict(row) for row in conn.execute(sa.select([table]))]
+    engine.execute(table.insert(), rows)
+
+    assert verify_chain(ChainedAuditLog, engine, chunk_size=1, workers=2) == []
+
+    engine.execute(table.update().where(table.c.id == 3).values(hash="0" * 64))
+
+    assert verify_chain(ChainedAuditLog, engine, chunk_size=1, workers=2) == [3, 4]
+
+
+def test_deduplicated_snapshots(db):
+    db.create_all()
+
+    obj = DedupChainedModel(name="foo")
+    obj.save()
+    obj.name = "bar"
+    obj.save()
+
+    assert verify_chain(DedupChainedAuditLog, db.engine) == []
+
+    # changing a snapshot breaks every entry that references it
+    with db.engine.begin() as conn:
+        conn.execute(
+            ChainedSnapshot.__table__.update()
+            .where(
+                ChainedSnapshot.__table__.c.hash
+                == snapshot_hash({"id": 1, "name": "bar"})
+            )
+            .values(data={"id": 1, "name": "other"})
+        )
+
+    assert verify_chain(DedupChainedAuditLog, db.engine) == [2]
@@ -1,10 +1,29 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.declarative import declared_attr
 from starlette_auth.tables import User
-from starlette_core.database import Base
+from starlette_core.database import Base, Session, metadata
 from starlette_core.testing import assert_model_field
 
-from starlette_audit.tables import Audited, AuditLogMixin
+from starlette_audit import tables
+from starlette_audit.tables import (
+    Audited,
+    AuditLogMixin,
+    AuditSnapshotMixin,
+    DeduplicatedSnapshotsMixin,
+    LatestStateMixin,
+    latest_state_upsert,
+    receive_exit,
+    retry_unwritten_entries,
+    snapshot_hash,
+    use_read_bind,
+    use_write_bind,
+)
 
 
 class AuditLog(AuditLogMixin, Base):
@@ -22,6 +41,92 @@ class MyModel(Audited, Base):
         return AuditLog
 
 
+class OtherModel(Audited, Base):
+    title = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return AuditLog
+
+
+class AuditSnapshot(AuditSnapshotMixin, Base):
+    pass
+
+
+class DedupAuditLog(DeduplicatedSnapshotsMixin, AuditLogMixin, Base):
+    created_by_id = sa.Column(sa.Integer, sa.ForeignKey(User.id), nullable=True)
+    created_by = orm.relationship(User)
+
+    @classmethod
+    def snapshot_class(cls):
+        return AuditSnapshot
+
+
+class DedupModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return DedupAuditLog
+
+
+class AuditLatestState(LatestStateMixin, Base):
+    pass
+
+
+class StateAuditLog(AuditLogMixin, Base):
+    created_by_id = sa.Column(sa.Integer, sa.ForeignKey(User.id), nullable=True)
+    created_by = orm.relationship(User)
+
+    @classmethod
+    def latest_state_class(cls):
+        return AuditLatestState
+
+
+class StateModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+    born_on = sa.Column(sa.Date)
+    seen_at = sa.Column(sa.DateTime)
+    height = sa.Column(sa.Numeric(5, 2))
+
+    @classmethod
+    def audit_class(cls):
+        return StateAuditLog
+
+
+class ShardedAuditLog(AuditLogMixin, Base):
+    __abstract__ = True
+    per_model_tables = True
+
+    @declared_attr
+    def created_by_id(cls):
+        return sa.Column(sa.Integer, sa.ForeignKey(User.id), nullable=True)
+
+    @declared_attr
+    def created_by(cls):
+        return orm.relationship(User)
+
+
+class ShardedModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return ShardedAuditLog
+
+
+class OtherShardedModel(Audited, Base):
+    name = sa.Column(sa.String(50))
+
+    @classmethod
+    def audit_class(cls):
+        return ShardedAuditLog
+
+
+# generates the per model audit log tables before they are created
+orm.configure_mappers()
+
+
 def test_fields():
     assert_model_field(AuditLog, "entity_type", sa.String, False, False, False, 255)
     assert_model_field(AuditLog, "entity_type_id", sa.String, False, False, False, 50)
@@ -145,6 +250,54 @@ def test_when_no_user(db):
     assert logs[0].created_by_id is None
 
 
+def test_entries_written_per_flush(db):
+    db.create_all()
+
+    inserts = []
+
+    def count_insert(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO auditlog"):
+            inserts.append(executemany)
+
+    session = Session()
+    session.add_all([MyModel(name="foo"), MyModel(name="bar"), OtherModel(title="baz")])
+
+    sa.event.listen(db.engine, "before_cursor_execute", count_insert)
+    try:
+        session.commit()
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", count_insert)
+
+    # a single executemany for all entries of the flush
+    assert inserts == [True]
+    assert sorted(
+        entry.data.get("name") or entry.data["title"] for entry in AuditLog.query
+    ) == ["bar", "baz", "foo"]
+
+    # entries are discarded along with a failed flush
+    with db.engine.begin() as conn:
+        conn.execute(
+            "CREATE TRIGGER reject BEFORE DELETE ON mymodel "
+            "BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+        )
+
+    session.add(MyModel(name="rolled back"))
+    session.delete(MyModel.query.filter_by(name="foo").one())
+    try:
+        with pytest.raises(sa.exc.IntegrityError):
+            session.commit()
+        session.rollback()
+    finally:
+        with db.engine.begin() as conn:
+            conn.execute("DROP TRIGGER reject")
+
+    session.add(MyModel(name="qux"))
+    session.commit()
+    assert AuditLog.query.count() == 4
+
+    Session.remove()
+
+
 def test_mapper_configuration(db):
     db.create_all()
 
@@ -155,3 +308,616 @@ def test_mapper_configuration(db):
     assert isinstance(obj.auditlog[0], AuditLog)
 
     assert obj.auditlog[0].audited_instance == obj
+
+
+def test_read_bind(db):
+    db.create_all()
+
+    replica = sa.create_engine("sqlite://")
+    metadata.create_all(replica)
+
+    Session.remove()
+    use_read_bind(AuditLog, replica)
+
+    try:
+        obj = MyModel(name="foo")
+        obj.save()
+
+        # entries are written to the primary, reads come from the replica
+        assert AuditLog.query.count() == 0
+        assert obj.auditlog == []
+
+        with db.engine.connect() as conn:
+            count = sa.select([sa.func.count()]).select_from(AuditLog.__table__)
+            assert conn.execute(count).scalar() == 1
+
+        # entries added to the session are flushed to the primary as well
+        session = Session()
+        session.add(
+            AuditLog(
+                entity_type="mymodel",
+                entity_type_id=str(obj.id),
+                entity_name="foo",
+                operation="UPDATE",
+                data={},
+                extra_data={},
+            )
+        )
+        session.commit()
+
+        with db.engine.connect() as conn:
+            assert conn.execute(count).scalar() == 2
+        with replica.connect() as conn:
+            assert conn.execute(count).scalar() == 0
+    finally:
+        Session.remove()
+        use_read_bind(AuditLog, None)
+
+
+def count_entries(engine):
+    with engine.connect() as conn:
+        count = sa.select([sa.func.count()]).select_from(AuditLog.__table__)
+        return conn.execute(count).scalar()
+
+
+def test_write_bind(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        obj = MyModel(name="foo")
+        obj.save()
+        obj.name = "bar"
+        obj.save()
+
+        assert count_entries(db.engine) == 0
+        assert count_entries(audit_db) == 2
+
+        # nothing is written when the transaction is rolled back
+        session = Session()
+        session.add(MyModel(name="baz"))
+        session.flush()
+        session.rollback()
+
+        assert count_entries(audit_db) == 2
+    finally:
+        use_write_bind(AuditLog, None)
+
+
+def test_write_bind_savepoint(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        session = Session()
+        session.add(MyModel(name="foo"))
+        session.flush()
+
+        session.begin_nested()
+        session.add(MyModel(name="bar"))
+        session.flush()
+        session.rollback()
+
+        session.begin_nested()
+        session.add(MyModel(name="baz"))
+        session.flush()
+        session.commit()
+
+        assert count_entries(audit_db) == 0
+
+        session.commit()
+
+        with audit_db.connect() as conn:
+            rows = conn.execute(sa.select([AuditLog.__table__])).fetchall()
+        assert sorted(row.data["name"] for row in rows) == ["baz", "foo"]
+    finally:
+        use_write_bind(AuditLog, None)
+
+
+def audited_names(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(sa.select([AuditLog.__table__])).fetchall()
+    return sorted(row.data["name"] for row in rows)
+
+
+def test_write_bind_failing_entry(db, caplog):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+    with audit_db.begin() as conn:
+        conn.execute(
+            "CREATE TRIGGER reject BEFORE INSERT ON auditlog "
+            "WHEN json_extract(NEW.data, '$.name') = 'poison' "
+            "BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+        )
+
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        MyModel(name="poison").save()
+        assert retry_unwritten_entries() == 1
+
+        # the failing entry doesn't hold back the others
+        for name in ("foo", "bar", "baz", "qux"):
+            MyModel(name=name).save()
+            assert name in audited_names(audit_db)
+
+        assert retry_unwritten_entries() == 1
+        assert "Dropping" not in caplog.text
+
+        MyModel(name="quux").save()
+
+        assert retry_unwritten_entries() == 0
+        assert "Dropping AuditLog entry after 5 failed writes" in caplog.text
+        assert '"name": "poison"' in caplog.text
+        assert audited_names(audit_db) == ["bar", "baz", "foo", "quux", "qux"]
+    finally:
+        use_write_bind(AuditLog, None)
+        Session.remove()
+
+
+def test_write_bind_unwritten_limit(db, caplog, monkeypatch):
+    db.create_all()
+
+    # the audit database is missing its tables
+    audit_db = sa.create_engine("sqlite://")
+
+    monkeypatch.setattr(tables, "MAX_UNWRITTEN_ENTRIES", 2)
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        for name in ("foo", "bar", "baz"):
+            MyModel(name=name).save()
+
+        # entries are kept while the write bind is down, up to the limit
+        assert retry_unwritten_entries() == 2
+        assert "Dropping AuditLog entry as too many are held" in caplog.text
+        assert '"name": "foo"' in caplog.text
+
+        receive_exit()
+
+        assert retry_unwritten_entries() == 0
+        assert "Dropping AuditLog entry as the process exits" in caplog.text
+        assert '"name": "baz"' in caplog.text
+    finally:
+        use_write_bind(AuditLog, None)
+        Session.remove()
+
+
+def test_write_bind_discarded_transaction(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        # closing the session discards the flushed changes and their entries
+        session = Session()
+        session.add(MyModel(name="discarded"))
+        session.flush()
+        session.close()
+
+        MyModel(name="kept").save()
+
+        assert audited_names(audit_db) == ["kept"]
+
+        # savepoints are discarded with the transaction they were made in
+        session = Session()
+        session.begin_nested()
+        session.add(MyModel(name="savepoint"))
+        session.flush()
+        session.commit()
+        session.rollback()
+
+        MyModel(name="other").save()
+
+        assert audited_names(audit_db) == ["kept", "other"]
+    finally:
+        use_write_bind(AuditLog, None)
+
+
+def test_write_bind_failure(db, caplog):
+    db.create_all()
+
+    # the audit database is missing its tables
+    audit_db = sa.create_engine("sqlite://")
+
+    use_write_bind(AuditLog, audit_db)
+
+    try:
+        obj = MyModel(name="foo")
+        obj.save()
+
+        assert "Could not write 1 AuditLog entries" in caplog.text
+        assert MyModel.query.count() == 1
+        assert retry_unwritten_entries() == 1
+
+        # the session is still usable and unwritten entries are retried
+        metadata.create_all(audit_db)
+        obj.name = "bar"
+        obj.save()
+
+        assert audited_names(audit_db) == ["bar", "foo"]
+        assert retry_unwritten_entries() == 0
+    finally:
+        use_write_bind(AuditLog, None)
+        Session.remove()
+
+
+def test_load_audited_instances(db):
+    db.create_all()
+
+    foo = MyModel(name="foo")
+    foo.save()
+    bar = MyModel(name="bar")
+    bar.save()
+    bar.name = "baz"
+    bar.save()
+    deleted = MyModel(name="deleted")
+    deleted.save()
+    deleted.delete()
+    other = OtherModel(title="other")
+    other.save()
+    other.title = "changed"
+    other.save()
+
+    Session.remove()
+    entries = AuditLog.query.order_by(AuditLog.id).all()
+    assert len(entries) == 7
+
+    queries = []
+
+    def count_query(*args):
+        queries.append(args)
+
+    sa.event.listen(db.engine, "before_cursor_execute", count_query)
+    try:
+        # a single query per entity type
+        AuditLog.load_audited_instances(entries)
+        assert len(queries) == 2
+
+        instances = [
+            (type(entry.audited_instance), entry.audited_instance.id)
+            if entry.audited_instance
+            else None
+            for entry in entries
+        ]
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", count_query)
+
+    assert instances == [
+        (MyModel, 1),
+        (MyModel, 2),
+        (MyModel, 2),
+        None,
+        None,
+        (OtherModel, 1),
+        (OtherModel, 1),
+    ]
+    assert len(queries) == 2
+
+
+def test_deduplicated_snapshots(db):
+    db.create_all()
+
+    assert "data" not in DedupAuditLog.__table__.columns
+    assert "extra_data" not in DedupAuditLog.__table__.columns
+
+    obj = DedupModel(name="foo")
+    obj.save()
+    obj.name = "bar"
+    obj.save()
+    obj.name = "foo"
+    obj.save()
+    obj.delete()
+
+    logs = DedupAuditLog.query.order_by(DedupAuditLog.id).all()
+
+    assert [log.operation for log in logs] == ["INSERT", "UPDATE", "UPDATE", "DELETE"]
+    assert [log.data for log in logs] == [
+        {"id": obj.id, "name": "foo"},
+        {"id": obj.id, "name": "bar"},
+        {"id": obj.id, "name": "foo"},
+        {"id": obj.id, "name": "foo"},
+    ]
+    assert [log.extra_data for log in logs] == [{}, {}, {}, {}]
+
+    # two distinct data payloads and one extra data payload
+    assert AuditSnapshot.query.count() == 3
+
+
+def test_deduplicated_snapshots_write_bind(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    use_write_bind(DedupAuditLog, audit_db)
+
+    try:
+        obj = DedupModel(name="foo")
+        obj.save()
+        obj.delete()
+    finally:
+        use_write_bind(DedupAuditLog, None)
+
+    with audit_db.connect() as conn:
+        count = sa.select([sa.func.count()]).select_from(AuditSnapshot.__table__)
+        assert conn.execute(count).scalar() == 2
+
+
+def test_deduplicated_snapshots_read_bind(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    Session.remove()
+    use_write_bind(DedupAuditLog, audit_db)
+    use_read_bind(DedupAuditLog, audit_db)
+
+    try:
+        obj = DedupModel(name="foo")
+        obj.save()
+
+        # snapshots are only in the audit database, and loaded from it
+        with db.engine.connect() as conn:
+            count = sa.select([sa.func.count()]).select_from(AuditSnapshot.__table__)
+            assert conn.execute(count).scalar() == 0
+
+        entry = DedupAuditLog.query.one()
+        assert entry.data == {"id": obj.id, "name": "foo"}
+        assert entry.extra_data == {}
+    finally:
+        use_write_bind(DedupAuditLog, None)
+        use_read_bind(DedupAuditLog, None)
+        Session.remove()
+
+
+def test_deduplicated_snapshots_manual_entry(db):
+    db.create_all()
+
+    entry = DedupAuditLog(
+        entity_type="dedupmodel",
+        entity_type_id="1",
+        entity_name="foo",
+        operation="INSERT",
+        data={"id": 1, "name": "foo"},
+        extra_data={},
+    )
+    assert entry.data == {"id": 1, "name": "foo"}
+    entry.save()
+
+    Session.remove()
+
+    entry = DedupAuditLog.query.one()
+    assert entry.data == {"id": 1, "name": "foo"}
+    assert entry.extra_data == {}
+    assert entry.data_hash == snapshot_hash({"id": 1, "name": "foo"})
+    assert AuditSnapshot.query.count() == 2
+
+    # assigning a payload again references the new snapshot
+    entry.data = {"id": 1, "name": "bar"}
+    entry.save()
+
+    Session.remove()
+
+    assert DedupAuditLog.query.one().data == {"id": 1, "name": "bar"}
+    assert AuditSnapshot.query.count() == 3
+
+
+def test_records_without_payload(db):
+    db.create_all()
+
+    obj = MyModel(name="foo")
+    obj.save()
+    obj.name = "bar"
+    obj.save()
+    obj.name = "baz"
+    obj.save()
+
+    Session.remove()
+
+    entries = AuditLog.query.options(AuditLog.without_payload()).all()
+    assert all("data" not in entry.__dict__ for entry in entries)
+    assert all("extra_data" not in entry.__dict__ for entry in entries)
+
+    # payloads are still loaded when accessed
+    assert entries[1].data == {"id": 1, "name": "bar"}
+
+    prior = entries[1].prior_records.all()
+    later = entries[1].later_records.all()
+    assert [entry.id for entry in prior] == [entries[0].id]
+    assert [entry.id for entry in later] == [entries[2].id]
+    assert "data" not in prior[0].__dict__
+    assert "data" not in later[0].__dict__
+
+
+def test_latest_state(db):
+    db.create_all()
+
+    obj = StateModel(name="foo")
+    obj.save()
+    obj.name = "bar"
+    obj.save()
+    other = StateModel(name="other")
+    other.save()
+
+    state = StateAuditLog.last_known_state("statemodel", obj.id)
+    assert state.operation == "UPDATE"
+    assert state.entry_count == 2
+    assert state.data["name"] == "bar"
+    assert AuditLatestState.query.count() == 2
+
+    id = obj.id
+    obj.delete()
+
+    state = StateAuditLog.last_known_state("statemodel", id)
+    assert state.operation == "DELETE"
+    assert state.entry_count == 3
+
+
+def test_latest_state_manual_entry(db):
+    db.create_all()
+
+    session = Session()
+    for operation in ("INSERT", "UPDATE"):
+        session.add(
+            StateAuditLog(
+                entity_type="statemodel",
+                entity_type_id="1",
+                entity_name="foo",
+                operation=operation,
+                data={"id": 1, "name": operation},
+                extra_data={},
+            )
+        )
+    session.commit()
+
+    state = StateAuditLog.last_known_state("statemodel", 1)
+    assert state.operation == "UPDATE"
+    assert state.entry_count == 2
+    assert state.data["name"] == "UPDATE"
+
+    Session.remove()
+
+
+def test_latest_state_read_bind(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    Session.remove()
+    use_write_bind(StateAuditLog, audit_db)
+    use_read_bind(StateAuditLog, audit_db)
+
+    try:
+        obj = StateModel(name="foo")
+        obj.save()
+        id = obj.id
+        obj.delete()
+
+        # latest states are only in the audit database, and read from it
+        with db.engine.connect() as conn:
+            count = sa.select([sa.func.count()]).select_from(AuditLatestState.__table__)
+            assert conn.execute(count).scalar() == 0
+
+        assert StateAuditLog.last_known_state("statemodel", id).operation == "DELETE"
+        assert StateModel.restore_deleted(id).name == "foo"
+    finally:
+        use_write_bind(StateAuditLog, None)
+        use_read_bind(StateAuditLog, None)
+        Session.remove()
+
+
+def test_latest_state_upsert():
+    table = AuditLatestState.__table__
+
+    upsert = latest_state_upsert("postgresql", table)
+    sql = str(upsert.compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (entity_type, entity_type_id) DO UPDATE" in sql
+    assert "entry_count = (auditlateststate.entry_count + excluded.entry_count)" in sql
+
+    upsert = latest_state_upsert("mysql", table)
+    sql = str(upsert.compile(dialect=mysql.dialect()))
+    assert "ON DUPLICATE KEY UPDATE" in sql
+
+    assert latest_state_upsert("oracle", table) is None
+
+
+def test_restore_deleted(db):
+    db.create_all()
+
+    obj = StateModel(
+        name="foo",
+        born_on=date(2000, 1, 2),
+        seen_at=datetime(2020, 1, 2, 3, 4, 5),
+        height=Decimal("1.23"),
+    )
+    obj.save()
+    id = obj.id
+
+    assert StateModel.restore_deleted(id) is None
+
+    obj.delete()
+
+    restored = StateModel.restore_deleted(id)
+    restored.save()
+
+    assert restored.id == id
+    assert restored.name == "foo"
+    assert restored.born_on == date(2000, 1, 2)
+    assert restored.seen_at == datetime(2020, 1, 2, 3, 4, 5)
+    assert restored.height == Decimal("1.23")
+    assert StateAuditLog.last_known_state("statemodel", id).operation == "INSERT"
+
+
+def test_restore_deleted_without_latest_state(db):
+    db.create_all()
+
+    obj = MyModel(name="foo")
+    obj.save()
+    id = obj.id
+    obj.delete()
+
+    restored = MyModel.restore_deleted(id)
+    assert restored.id == id
+    assert restored.name == "foo"
+
+
+def test_per_model_tables(db):
+    db.create_all()
+
+    foo = ShardedModel(name="foo")
+    foo.save()
+    foo.name = "bar"
+    foo.save()
+    OtherShardedModel(name="baz").save()
+
+    classes = ShardedAuditLog.model_audit_classes()
+    assert set(classes) == {"shardedmodel", "othershardedmodel"}
+    assert ShardedModel.audit_table_class() is classes["shardedmodel"]
+    assert classes["shardedmodel"].__tablename__ == "shardedmodel_shardedauditlog"
+
+    entries = classes["shardedmodel"].query.order_by("id").all()
+    assert [entry.operation for entry in entries] == ["INSERT", "UPDATE"]
+    assert [entry.entry_id for entry in entries] == ["shardedmodel:1", "shardedmodel:2"]
+    assert foo.auditlog == entries[::-1]
+    assert entries[0].audited_instance == foo
+
+    other = classes["othershardedmodel"].query.one()
+    assert other.data == {"id": 1, "name": "baz"}
+
+
+def test_per_model_tables_write_bind(db):
+    db.create_all()
+
+    audit_db = sa.create_engine("sqlite://")
+    metadata.create_all(audit_db)
+
+    Session.remove()
+    use_write_bind(ShardedAuditLog, audit_db)
+
+    try:
+        ShardedModel(name="foo").save()
+    finally:
+        use_write_bind(ShardedAuditLog, None)
+
+    table = ShardedModel.audit_table_class().__table__
+    count = sa.select([sa.func.count()]).select_from(table)
+    with db.engine.connect() as conn:
+        assert conn.execute(count).scalar() == 0
+    with audit_db.connect() as conn:
+        assert conn.execute(count).scalar() == 1